@@ -2,15 +2,69 @@
 
 import os
 import argparse
+import hashlib
+import heapq
+import json
+import math
 import re
+import resource
+import struct
+import shutil
+import socket
+import sqlite3
+import statistics
 import subprocess
 import sys
 import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 
-from astropy.io import ascii
-from dask.distributed import Client, get_client
+import numpy as np
+from astropy.io import ascii, fits
+from astropy.table import Table
+from astropy.wcs import WCS
+from dask.distributed import Client, as_completed, get_client, get_worker
 
 verbose = False
+overlap_finder = 'mOverlaps'
+overlap_area = False
+prune_keep = None
+cull_images = False
+coverage_depth = None
+coverage_weight = None
+fast_project = False
+projection_engine = 'mProject'
+projection_batch = 1
+background_engine = 'mBackground'
+data_plane = 'disk'
+scratch_dir = None
+scratch_limit = 0
+gc_intermediates = False
+output_dir = None
+stage_out_mode = 'copy'
+stage_out_threads = 4
+pixel_type = 'float64'
+mosaic_compression = None
+tile_pyramid = None
+tile_size = 256
+pyramid_threads = 4
+renderer = 'mViewer'
+render_threads = 4
+preview_scale = None
+progressive_tiles = None
+update_mode = False
+trace_prefix = None
+archive_url = None
+runtime_db = None
+
+# Executables implemented in this script: Task.run calls these functions
+# in-process instead of running a command
+in_process_executables = {}
+# In-process executables that run a command on their inputs, which
+# therefore have to be on disk
+command_executables = set()
 
 
 '''
@@ -21,7 +75,24 @@ class Task:
         self.executable = executable
         self.inputfiles = []
         self.outputfiles = []
+        self.stageoutfiles = []
+        # outputs that --gc-intermediates leaves in data/, for --update
+        # to reuse on the next run
+        self.keepfiles = []
         self.arguments = []
+        # outputs handed to consumers in memory, and those of them
+        # that never need to be written to disk
+        self.memory_outputs = set()
+        self.memory_only = set()
+        # tasks with a higher priority are run first among the ready ones
+        self.priority = 0
+        # tasks that don't wait for the level barrier of Workflow.run only
+        # wait for the tasks producing their inputs
+        self.wait_for_level = True
+        # band the task belongs to, for reporting
+        self.band = None
+        # absolute path of the data/ directory, set when the workflow runs
+        self.data_dir = None
 
     '''
     Method to add input files to the task
@@ -33,9 +104,13 @@ class Task:
     '''
     Method to add output files to the task
     '''
-    def add_outputs(self, *args, stage_out):
+    def add_outputs(self, *args, stage_out, keep=False):
         for arg in args:
             self.outputfiles.append(arg) 
+            if stage_out:
+                self.stageoutfiles.append(arg)
+            if keep:
+                self.keepfiles.append(arg)
 
     '''
     Method to add command-line arguments to the task
@@ -60,14 +135,17 @@ class Task:
     '''
     Method to run the task
     '''
-    def run(self, *args):
+    def run(self, *args, inputs=None, submitted=None):
         global verbose
 
         # sys.stderr.write("Current Working Directory: %s \n" % os.getcwd())
         sys.stderr.write("Running a " + self.executable + " task with input files {" + ', '.join(self.inputfiles) + "} " + 
         "and output files {" + ', '.join(self.outputfiles) + "}\n")
 
-        cmd = self.executable + " " + ' '.join(self.arguments)
+        # intermediate outputs go to the scratch tier, if it has room left
+        routed = scratch_outputs(self)
+        arguments = [os.path.join(scratch_dir, arg) if arg in routed else arg for arg in self.arguments]
+        cmd = self.executable + " " + ' '.join(arguments)
 
         if verbose:
             redirect = None
@@ -75,17 +153,562 @@ class Task:
         else:
             redirect = subprocess.DEVNULL
 
+        # commands and in-process executables work in data/, without
+        # changing the working directory shared by the worker's threads
+        data_dir = self.data_dir or os.path.abspath('data')
         start = time.perf_counter()
-        if (os.path.basename(os.getcwd()) != "data"):
-            os.chdir("./data")
-        if subprocess.call(cmd, shell=True, stderr=redirect, stdout=redirect) != 0:
-            sys.stderr.write('\tCommand ' + cmd + ' failed!')
-            sys.exit(1)
+        started = time.time()
+        # the dependencies (the level barrier, and the tasks producing the
+        # inputs) resolved when the last of them was done
+        ready = submitted
+        for dependency in list(args) + list(inputs or []):
+            done = dependency['trace']['end'] if isinstance(dependency, dict) else dependency
+            if done != None and (ready == None or done > ready):
+                ready = done
+        input_bytes = file_bytes([os.path.join(data_dir, f) for f in self.inputfiles])
+        exit_code = 0
+        products = {}
+        if self.executable in in_process_executables:
+            plane = DataPlane(inputs, self.memory_outputs, self.memory_only, routed, data_dir)
+            cpu_before = time.thread_time()
+            io_before = read_proc_io('/proc/thread-self/io')
+            try:
+                in_process_executables[self.executable](plane, *self.arguments)
+                products = plane.outputs
+            except Exception as e:
+                sys.stderr.write('\tIn-process ' + cmd + ' failed: ' + str(e) + '\n')
+                sys.exit(1)
+            usage = thread_usage(cpu_before, io_before)
+        else:
+            (exit_code, usage) = call_with_usage(cmd, redirect, data_dir)
+            if exit_code != 0:
+                sys.stderr.write('\tCommand ' + cmd + ' failed!')
+                sys.exit(1)
+        link_scratch_outputs(routed, data_dir)
         end = time.perf_counter()
+        output_bytes = file_bytes([os.path.join(data_dir, f) for f in self.outputfiles])
 
-        os.chdir("../")
         sys.stderr.write("  [executed in " + str("{:.2f}".format(end - start)) + " seconds]\n")
 
+        trace = {
+            'executable': self.executable,
+            'band': self.band,
+            'outputs': self.outputfiles,
+            'submitted': submitted,
+            'ready': ready,
+            'start': started,
+            'end': started + (end - start),
+            'host': socket.gethostname(),
+            'worker': worker_name(),
+            'exit_code': exit_code,
+            'arguments': ' '.join(arg for arg in self.arguments
+                                  if arg not in self.inputfiles and arg not in self.outputfiles),
+            'input_bytes': input_bytes,
+            'output_bytes': output_bytes,
+            'usage': usage,
+        }
+        return {'products': products, 'trace': trace}
+
+
+'''
+DataPlane class: gives in-process executables access to the images
+produced by earlier in-process tasks, which Dask hands over from worker
+memory, and decides which of their outputs are kept in memory and which
+are written to disk
+'''
+class DataPlane:
+    def __init__(self, inputs, memory_outputs, memory_only, routed=(), data_dir='data'):
+        self.products = {}
+        self.data_dir = data_dir
+        for result in (inputs or []):
+            self.products.update(result['products'])
+        self.memory_outputs = memory_outputs
+        self.memory_only = memory_only
+        self.routed = routed
+        self.outputs = {}
+
+    '''
+    Method to get the path of a file of the data/ directory
+    '''
+    def path(self, name):
+        return os.path.join(self.data_dir, name)
+
+    '''
+    Method to read an image, from memory if it was handed over,
+    from disk otherwise. Returns (data, header)
+    '''
+    def read(self, name):
+        if name in self.products:
+            return self.products[name]
+        return fits.getdata(self.path(name), header=True)
+
+    '''
+    Method to write an image, to memory and/or to disk
+    '''
+    def write(self, name, data, header):
+        if name in self.memory_outputs:
+            self.outputs[name] = (data, header)
+        if name not in self.memory_only:
+            if name in self.routed:
+                fits.writeto(os.path.join(scratch_dir, name), data, header, overwrite=True)
+            else:
+                fits.writeto(self.path(name), data, header, overwrite=True)
+
+
+'''
+Function to compute the number of bytes used in the scratch tier
+'''
+def scratch_usage():
+    usage = 0
+    for entry in os.scandir(scratch_dir):
+        if entry.is_file(follow_symlinks=False):
+            usage += entry.stat().st_size
+    return usage
+
+'''
+Function to decide which outputs of a task are written to the scratch
+tier: all of its intermediate (not staged-out) outputs while the scratch
+tier is under its capacity limit, none of them once it is full
+'''
+def scratch_outputs(task):
+    if scratch_dir == None:
+        return set()
+    if scratch_limit > 0 and scratch_usage() >= scratch_limit:
+        return set()
+    return set(f for f in task.outputfiles if f not in task.stageoutfiles)
+
+'''
+Function to make the outputs written to the scratch tier visible in
+the data/ directory, where the Montage executables look for them
+'''
+def link_scratch_outputs(routed, data_dir):
+    for f in routed:
+        path = os.path.join(scratch_dir, f)
+        link = os.path.join(data_dir, f)
+        if not os.path.exists(path):
+            continue
+        if os.path.islink(link) and os.readlink(link) == path:
+            continue
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(path, link)
+
+'''
+StageOut class: copies (or moves) final products to the output
+directory in background threads, recording a SHA-256 checksum of
+each exported file
+'''
+class StageOut:
+    def __init__(self, directory, mode, threads):
+        self.directory = directory
+        self.mode = mode
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.futures = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    '''
+    Method to start exporting a file (or directory) of data/
+    '''
+    def submit(self, f):
+        sys.stderr.write("Staging out " + f + " to " + self.directory + "\n")
+        self.futures.append(self.pool.submit(self.export, f))
+
+    '''
+    Method to export a file (or directory), returning a list of
+    (relative path, checksum) pairs
+    '''
+    def export(self, f):
+        source = os.path.join('data', f)
+        if os.path.isdir(source):
+            paths = []
+            for (root, dirs, files) in os.walk(source):
+                for name in files:
+                    paths.append(os.path.relpath(os.path.join(root, name), 'data'))
+        else:
+            paths = [f]
+
+        checksums = []
+        for path in paths:
+            destination = os.path.join(self.directory, path)
+            if not os.path.isdir(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+            digest = hashlib.sha256()
+            with open(os.path.join('data', path), 'rb') as fin, open(destination, 'wb') as fout:
+                for chunk in iter(lambda: fin.read(1 << 20), b''):
+                    digest.update(chunk)
+                    fout.write(chunk)
+            checksums.append((path, digest.hexdigest()))
+
+        if self.mode == 'move':
+            if os.path.isdir(source):
+                shutil.rmtree(source)
+            else:
+                os.remove(source)
+        return checksums
+
+    '''
+    Method to wait for all the exports, and write the checksum manifest
+    '''
+    def finish(self):
+        start = time.perf_counter()
+        checksums = []
+        for future in self.futures:
+            checksums.extend(future.result())
+        self.pool.shutdown()
+        end = time.perf_counter()
+
+        with open(os.path.join(self.directory, 'SHA256SUMS'), 'a') as manifest:
+            for (path, checksum) in sorted(checksums):
+                manifest.write(checksum + '  ' + path + '\n')
+        sys.stderr.write("Staged out " + str(len(checksums)) + " files (waited " +
+                         str("{:.2f}".format(end - start)) + " seconds after the last task).\n")
+
+
+'''
+Function to delete an intermediate file from data/, and from the
+scratch tier if data/ only holds a link to it
+'''
+def remove_intermediate(f):
+    path = os.path.join('data', f)
+    if os.path.islink(path):
+        target = os.readlink(path)
+        if os.path.isfile(target):
+            os.remove(target)
+    if os.path.lexists(path):
+        os.remove(path)
+
+'''
+Function used as a barrier dependency for tasks returning in-memory
+products, so that depending on it doesn't move the products around
+'''
+def task_done(result):
+    return {'products': {}, 'trace': result['trace']}
+
+'''
+Function used as the barrier between two levels of the workflow,
+returning the time the level was done
+'''
+def level_done(results):
+    return time.time()
+
+'''
+Function to compute the total size of the given files (or directories)
+'''
+def file_bytes(files):
+    total = 0
+    for f in files:
+        if os.path.isfile(f):
+            total += os.path.getsize(f)
+        elif os.path.isdir(f):
+            for (root, dirs, names) in os.walk(f):
+                total += sum(os.path.getsize(os.path.join(root, name)) for name in names)
+    return total
+
+'''
+Function to read the I/O counters of a process (or thread) from
+/proc. Returns None where /proc is not available
+'''
+def read_proc_io(path):
+    counters = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                (key, value) = line.split(':')
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        return None
+    return {'read_chars': counters.get('rchar', 0),
+            'write_chars': counters.get('wchar', 0),
+            'read_bytes': counters.get('read_bytes', 0),
+            'write_bytes': counters.get('write_bytes', 0)}
+
+'''
+Program through which call_with_usage() runs a command. A child forked
+from the worker starts with the worker's resident set as its high-water
+mark, and exec() carries that over, so wait4() on it reports the peak
+RSS of the worker rather than that of the command. Forked from this
+small interpreter instead, the command's usage is its own: the helper
+reads it with wait4(), and the I/O counters from /proc/<pid>/io while
+the exited child is still a zombie (the shell's counters include those
+of the commands it ran), and writes them as JSON to the given pipe
+'''
+usage_helper = '''
+import json, os, sys
+(fd, cmd) = (int(sys.argv[1]), sys.argv[2])
+pid = os.fork()
+if pid == 0:
+    os.execv('/bin/sh', ['sh', '-c', cmd])
+usage = {}
+if hasattr(os, 'waitid'):
+    os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+    try:
+        with open('/proc/%d/io' %(pid)) as f:
+            counters = dict((key, int(value)) for (key, value) in (line.split(':') for line in f))
+        usage = {'read_chars': counters.get('rchar', 0), 'write_chars': counters.get('wchar', 0),
+                 'read_bytes': counters.get('read_bytes', 0), 'write_bytes': counters.get('write_bytes', 0)}
+    except (OSError, ValueError):
+        pass
+(pid, status, rusage) = os.wait4(pid, 0)
+usage.update({'exit_code': os.waitstatus_to_exitcode(status), 'cpu_user': rusage.ru_utime,
+              'cpu_sys': rusage.ru_stime, 'max_rss': rusage.ru_maxrss * 1024})
+os.write(fd, json.dumps(usage).encode())
+'''
+
+'''
+Function to run a command through usage_helper and collect its
+resource usage: user/sys CPU time, peak RSS and I/O bytes. Should the
+helper not report, the usage is unknown and only the exit code is kept
+'''
+def call_with_usage(cmd, redirect, cwd):
+    (read_fd, write_fd) = os.pipe()
+    try:
+        proc = subprocess.Popen([sys.executable, '-c', usage_helper, str(write_fd), cmd],
+                                stderr=redirect, stdout=redirect, cwd=cwd, pass_fds=(write_fd,))
+    finally:
+        os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as pipe:
+        report = pipe.read()
+    proc.wait()
+    try:
+        usage = json.loads(report)
+    except ValueError:
+        return (proc.returncode or 1, {'cpu_user': 0.0, 'cpu_sys': 0.0})
+    return (usage.pop('exit_code'), usage)
+
+'''
+Function to compute the resource usage of an in-process task from
+the CPU time of its thread, all of it counted as user time. Threads
+share the address space, so there is no peak RSS of the task itself:
+the one recorded, as worker_rss, is that of the whole worker process
+'''
+def thread_usage(cpu_before, io_before):
+    usage = {'cpu_user': time.thread_time() - cpu_before,
+             'cpu_sys': 0.0,
+             'worker_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    io_after = read_proc_io('/proc/thread-self/io')
+    if io_before != None and io_after != None:
+        for key in io_after:
+            usage[key] = io_after[key] - io_before[key]
+    return usage
+
+'''
+Function to print the resource usage of the tasks, aggregated per
+executable and band: CPU time against wall time tells CPU-bound stages
+from the ones waiting on disk, and the peak RSS of the commands sizes
+the workers (in-process stages have none of their own and show '-')
+'''
+def resource_summary(traces, output):
+    stages = {}
+    for record in traces:
+        key = (record['executable'], str(record['band']))
+        stage = stages.setdefault(key, {'tasks': 0, 'wall': 0.0, 'cpu': 0.0,
+                                        'max_rss': None, 'read': 0, 'write': 0})
+        usage = record['usage']
+        stage['tasks'] += 1
+        stage['wall'] += record['end'] - record['start']
+        stage['cpu'] += usage['cpu_user'] + usage['cpu_sys']
+        if usage.get('max_rss') != None:
+            stage['max_rss'] = max(stage['max_rss'] or 0, usage['max_rss'])
+        stage['read'] += usage.get('read_chars', 0)
+        stage['write'] += usage.get('write_chars', 0)
+
+    mib = 1024.0 ** 2
+    output.write('%-16s %-6s %6s %10s %10s %6s %10s %10s %11s\n' %('executable', 'band',
+                 'tasks', 'wall (s)', 'cpu (s)', 'cpu %', 'rss (MiB)', 'read (MiB)', 'write (MiB)'))
+    for (key, stage) in sorted(stages.items(), key=lambda item: -item[1]['wall']):
+        load = 100.0 * stage['cpu'] / stage['wall'] if stage['wall'] > 0 else 0.0
+        rss = '-' if stage['max_rss'] == None else '%.1f' %(stage['max_rss'] / mib)
+        output.write('%-16s %-6s %6d %10.2f %10.2f %6.0f %10s %10.1f %11.1f\n' %(key[0], key[1],
+                     stage['tasks'], stage['wall'], stage['cpu'], load,
+                     rss, stage['read'] / mib, stage['write'] / mib))
+
+'''
+Function to open the runtime database, creating its table if needed.
+The peak RSS of the commands is kept in peak_rss: databases written
+before it was measured in the command rather than in the worker have
+their wrong values in max_rss, which is no longer read
+'''
+def open_runtime_db(path):
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE IF NOT EXISTS tasks (run REAL, executable TEXT, band TEXT, arguments TEXT, '
+               'input_bytes INTEGER, output_bytes INTEGER, duration REAL, cpu REAL, peak_rss INTEGER, host TEXT)')
+    if 'peak_rss' not in [column[1] for column in db.execute('PRAGMA table_info(tasks)')]:
+        db.execute('ALTER TABLE tasks ADD COLUMN peak_rss INTEGER')
+    db.execute('CREATE INDEX IF NOT EXISTS tasks_executable ON tasks (executable)')
+    return db
+
+'''
+Function to add the measurements of the tasks of a run to the runtime
+database
+'''
+def record_runtimes(path, traces, run):
+    db = open_runtime_db(path)
+    with db:
+        db.executemany('INSERT INTO tasks (run, executable, band, arguments, input_bytes, output_bytes, '
+                       'duration, cpu, peak_rss, host) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       [(run, r['executable'], r['band'], r['arguments'], r['input_bytes'], r['output_bytes'],
+                         r['end'] - r['start'], r['usage']['cpu_user'] + r['usage']['cpu_sys'],
+                         r['usage'].get('max_rss'), r['host']) for r in traces])
+    db.close()
+
+'''
+Function to fit a cost model per executable from the latest runs in the
+runtime database: the duration is linear in the input bytes when the
+inputs vary enough, and the median duration otherwise. The memory is
+the 90th percentile of the peak RSS, None for in-process executables
+and for history without it
+'''
+def load_cost_model(path, history=1000):
+    db = open_runtime_db(path)
+    model = {}
+    for (executable,) in db.execute('SELECT DISTINCT executable FROM tasks').fetchall():
+        rows = db.execute('SELECT input_bytes, duration, output_bytes, peak_rss FROM tasks '
+                          'WHERE executable = ? ORDER BY rowid DESC LIMIT ?', (executable, history)).fetchall()
+        x = np.array([row[0] for row in rows], dtype=float)
+        y = np.array([row[1] for row in rows], dtype=float)
+        cost = {'median': float(np.median(y)), 'slope': 0.0, 'intercept': float(np.median(y)),
+                'output_bytes': float(np.median([row[2] for row in rows])),
+                'memory': None}
+        rss = [row[3] for row in rows if row[3] != None]
+        if len(rss) > 0:
+            cost['memory'] = float(np.percentile(rss, 90))
+        if len(np.unique(x)) >= 3:
+            (slope, intercept) = np.polyfit(x, y, 1)
+            if slope > 0:
+                (cost['slope'], cost['intercept']) = (float(slope), float(intercept))
+        model[executable] = cost
+    db.close()
+    return model
+
+'''
+Function to predict the duration and memory of every task of the
+workflow. The input sizes are those of the files in data/, and the
+model's output sizes for intermediate files; tasks with inputs of
+unknown size get the median duration. Executables never seen get None
+'''
+def task_costs(wf, model):
+    sizes = {}
+    costs = []
+    for task in wf.tasks:
+        cost = model.get(task.executable)
+        if cost == None:
+            costs.append((None, None))
+            continue
+        input_bytes = 0
+        known = True
+        for f in task.inputfiles:
+            path = os.path.join('data', f)
+            if f in sizes:
+                input_bytes += sizes[f]
+            elif os.path.isfile(path):
+                input_bytes += os.path.getsize(path)
+            else:
+                known = False
+        if known:
+            duration = max(cost['intercept'] + cost['slope'] * input_bytes, 0.0)
+        else:
+            duration = cost['median']
+        costs.append((duration, cost['memory']))
+        for f in task.outputfiles:
+            sizes[f] = cost['output_bytes'] / len(task.outputfiles)
+    return costs
+
+'''
+Function to compute the level of every task, as Workflow.run submits
+them
+'''
+def task_levels(tasks):
+    producer = {}
+    levels = []
+    for (i, task) in enumerate(tasks):
+        level = 0
+        for f in task.inputfiles:
+            if f in producer:
+                level = max(level, levels[producer[f]] + 1)
+        levels.append(level)
+        for f in task.outputfiles:
+            producer[f] = i
+    return levels
+
+'''
+Function to give the tasks critical-path priorities from their
+predicted durations: the longer the chain of work a task leads to, the
+earlier it runs among the ready tasks. Ranks are in milliseconds, and
+priorities set by the workflow generation, such as the progressive tile
+order, are added to them so that they still order tasks of equal rank
+'''
+def set_cost_priorities(wf, costs):
+    consumers = {}
+    for (i, task) in enumerate(wf.tasks):
+        for f in task.inputfiles:
+            consumers.setdefault(f, []).append(i)
+    ranks = [0.0] * len(wf.tasks)
+    for i in reversed(range(len(wf.tasks))):
+        successors = [j for f in wf.tasks[i].outputfiles for j in consumers.get(f, [])]
+        ranks[i] = (costs[i][0] or 0.0) + max([ranks[j] for j in successors], default=0.0)
+    for (task, rank) in zip(wf.tasks, ranks):
+        task.priority += int(rank * 1000)
+
+'''
+Function to estimate the makespan of the workflow on the given number
+of slots, as Workflow.run runs it: the levels one after the other, the
+tasks of a level assigned longest first to the least loaded slot
+'''
+def estimate_makespan(wf, costs, slots):
+    levels = task_levels(wf.tasks)
+    by_level = {}
+    for (level, cost) in zip(levels, costs):
+        by_level.setdefault(level, []).append(cost[0] or 0.0)
+    makespan = 0.0
+    for level in sorted(by_level):
+        loads = [0.0] * slots
+        for duration in sorted(by_level[level], reverse=True):
+            heapq.heappush(loads, heapq.heappop(loads) + duration)
+        makespan += max(loads)
+    return makespan
+
+'''
+Function to get the name of the Dask worker running the current task
+'''
+def worker_name():
+    try:
+        return get_worker().address
+    except ValueError:
+        return 'pid-%d' %(os.getpid())
+
+'''
+Function to write task trace records as JSON lines, and as a
+Chrome-trace/Perfetto file with one row per worker, times relative
+to the start of the workflow. The time between the submission of a
+task and its start is split into waiting, for its dependencies, and
+queued, for a thread once they are done
+'''
+def write_trace(traces, prefix, origin):
+    with open(prefix + '.jsonl', 'w') as f:
+        for record in traces:
+            f.write(json.dumps(record) + '\n')
+
+    events = []
+    for record in traces:
+        args = dict(record)
+        # time spent waiting for the dependencies, then for a thread
+        if record['submitted'] != None:
+            args['waiting'] = record['ready'] - record['submitted']
+            args['queued'] = record['start'] - record['ready']
+        events.append({
+            'name': record['executable'],
+            'cat': str(record['band']),
+            'ph': 'X',
+            'ts': (record['start'] - origin) * 1e6,
+            'dur': (record['end'] - record['start']) * 1e6,
+            'pid': record['host'],
+            'tid': record['worker'],
+            'args': args,
+        })
+    with open(prefix + '.json', 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
 
 '''
 Workflow class
@@ -151,6 +774,56 @@ class Workflow:
 
         sys.stderr.write("Downloaded " + str(count) + " files.\n")
 
+    '''
+    Method to save the planned workflow as JSON, with the sizes of its
+    input files, for montage-workflow-eval/simulate-schedule.py
+    '''
+    def save_plan(self, path):
+        produced = set()
+        for task in self.tasks:
+            produced.update(task.outputfiles)
+        input_sizes = {}
+        for task in self.tasks:
+            for f in task.inputfiles:
+                if f not in produced and os.path.isfile(os.path.join('data', f)):
+                    input_sizes[f] = os.path.getsize(os.path.join('data', f))
+
+        tasks = []
+        for task in self.tasks:
+            tasks.append({'executable': task.executable, 'band': task.band, 'priority': task.priority,
+                          'inputs': task.inputfiles, 'outputs': task.outputfiles,
+                          'stage_out': task.stageoutfiles, 'wait_for_level': task.wait_for_level})
+        with open(path, 'w') as f:
+            json.dump({'tasks': tasks, 'input_sizes': input_sizes}, f)
+
+    '''
+    Method to decide which outputs of in-process tasks are handed over
+    in memory: only the ones that then skip the disk entirely, as all
+    their consumers are in-process and they are not staged out. An
+    image that some command reads is written anyway, and a copy kept
+    in memory for the in-process consumers would only add to the
+    memory of the workers. In the standard workflow every image has
+    such a consumer (mDiffFit, mImgtbl, mAdd or mAddTilePy), so this
+    hands nothing over
+    '''
+    def plan_data_plane(self):
+        consumers = {}
+        for task in self.tasks:
+            for f in task.inputfiles:
+                consumers.setdefault(f, []).append(task)
+
+        # executables running a command read and write files on disk
+        in_memory = set(in_process_executables) - command_executables
+        for task in self.tasks:
+            if task.executable not in in_memory:
+                continue
+            for f in task.outputfiles:
+                if f not in consumers or f in task.stageoutfiles:
+                    continue
+                if all(c.executable in in_memory for c in consumers[f]):
+                    task.memory_outputs.add(f)
+                    task.memory_only.add(f)
+
     '''
     Method to execute the workflow sequentially
     '''
@@ -159,6 +832,7 @@ class Workflow:
         sys.stderr.write("Add task to DASK client...\n")
 
         start = time.perf_counter()
+        origin = time.time()
         # Make a dictionaty of all the tasks' output files, some of which
         # serve as input to other tasks. The dictionary key is the file name,
         # and the value is true if the file has been produced already, false 
@@ -166,12 +840,51 @@ class Workflow:
         # the worklow's input file
         all_output_files = {}
         for task in self.tasks:
+            task.data_dir = os.path.abspath('data')
             for f in task.outputfiles:
                 all_output_files[f] = False
     
-        ready_list = []
+        # With the memory data plane, outputs of in-process tasks that are
+        # only consumed by in-process tasks are handed over in worker
+        # memory instead of being written to disk
+        if data_plane == 'memory':
+            self.plan_data_plane()
+        producers = {}
+
+        # Count the remaining consumers of every produced file, so that
+        # intermediates can be released and final products moved once
+        # the last of them is done
+        remaining_consumers = {}
+        for task in self.tasks:
+            for f in set(task.inputfiles):
+                if f in all_output_files:
+                    remaining_consumers[f] = remaining_consumers.get(f, 0) + 1
+        stage_out_files = set()
+        kept_files = set()
+        for task in self.tasks:
+            stage_out_files.update(task.stageoutfiles)
+            kept_files.update(task.keepfiles)
+        future_tasks = {}
+
+        # Final products are exported in the background while the rest of
+        # the workflow runs
+        if output_dir != None:
+            stage_out = StageOut(output_dir, stage_out_mode, stage_out_threads)
+        else:
+            stage_out = None
+        produced = set()
+
+        # level barriers go before every ready task, so that the next
+        # level is released as soon as possible
+        barrier_priority = max([task.priority for task in self.tasks], default=0) + 1
+        barrier = None
         client = get_client()
         all_futures = []
+        # futures of the tasks by output file, and the outputs of the tasks
+        # that don't wait for the level barrier, whose consumers have to
+        # wait for them explicitly
+        file_futures = {}
+        unlevelled = set()
 
         # Loop until tasks remain (yes, this loop "destroys" the workflow)
         while len(self.tasks) > 0:
@@ -195,32 +908,1261 @@ class Workflow:
             # If we found a ready task, we run it
             if len(ready_tasks) != 0:
                 for task in ready_tasks:
-                    if len(ready_list) == 0:
-                        x = client.submit(task.run)
-                        ready_futures.append(x)
-                        all_futures.append(x)
+                    inputs = []
+                    for f in task.inputfiles:
+                        if f in producers and producers[f] not in inputs:
+                            inputs.append(producers[f])
+                    if len(inputs) == 0:
+                        inputs = None
+
+                    if task.wait_for_level:
+                        dependencies = [] if barrier == None else [barrier]
+                        dependency_files = [f for f in task.inputfiles if f in unlevelled]
                     else:
-                        x = client.submit(task.run, ready_list[len(ready_list)-1])
+                        dependencies = []
+                        dependency_files = [f for f in task.inputfiles if f in file_futures]
+                    for f in dependency_files:
+                        if file_futures[f] not in dependencies:
+                            dependencies.append(file_futures[f])
+                    x = client.submit(task.run, *dependencies, inputs=inputs,
+                                      submitted=time.time(), priority=task.priority)
+
+                    if len(task.memory_outputs) > 0:
+                        for f in task.memory_outputs:
+                            producers[f] = x
+                        x = client.submit(task_done, x)
+                    if task.wait_for_level:
                         ready_futures.append(x)
-                        all_futures.append(x)
-                    
+                    all_futures.append(x)
+                    future_tasks[x] = task
+
                     # Mark its output files as produced
                     for f in task.outputfiles:
                         all_output_files[f] = True
-                    
-                    self.tasks.remove(task)
-                ready_list.append(ready_futures)
+                        file_futures[f] = x
+                        if not task.wait_for_level:
+                            unlevelled.add(f)
+
+                submitted = set(ready_tasks)
+                self.tasks = [task for task in self.tasks if task not in submitted]
+                # the next level waits on a single barrier future rather than
+                # on every task of this one, which keeps the task graph linear
+                # in the number of tasks. A level of tasks that don't wait
+                # for the barrier keeps the previous one
+                if len(ready_futures) > 0:
+                    barrier = client.submit(level_done, ready_futures, priority=barrier_priority)
             else:
                 # This should never happen
                 sys.stderr.write("FATAL ERROR: No ready task found\n")
                 sys.exit(1)
 
-        client.gather(all_futures)
+        self.traces = []
+        for future in as_completed(all_futures):
+            self.traces.append(future.result()['trace'])
+            task = future_tasks.pop(future)
+            produced.update(task.outputfiles)
+            for f in set(task.inputfiles):
+                if f not in remaining_consumers:
+                    continue
+                remaining_consumers[f] -= 1
+                if remaining_consumers[f] == 0:
+                    del remaining_consumers[f]
+                    if f in stage_out_files:
+                        if stage_out != None and stage_out.mode == 'move' and f in produced:
+                            stage_out.submit(f)
+                        continue
+                    # drop in-memory copies, and the file itself if asked to
+                    producers.pop(f, None)
+                    if gc_intermediates and f not in kept_files:
+                        remove_intermediate(f)
+            if stage_out != None:
+                for f in task.stageoutfiles:
+                    # products still needed by other tasks are only moved after them
+                    if stage_out.mode == 'copy' or f not in remaining_consumers:
+                        stage_out.submit(f)
+        if stage_out != None:
+            stage_out.finish()
         end = time.perf_counter()
         sys.stderr.write("Workflow execution done in " +  str("{:.2f}".format(end - start)) + " seconds.\n")
 
         with open("dask.txt", "a") as output:
             output.write("Workflow execution done in " +  str("{:.2f}".format(end - start)) + " seconds.\n")
+        resource_summary(self.traces, sys.stderr)
+
+        if runtime_db != None:
+            record_runtimes(runtime_db, self.traces, origin)
+        if trace_prefix != None:
+            write_trace(self.traces, trace_prefix, origin)
+            sys.stderr.write("Task trace written to " + trace_prefix + ".jsonl and " + trace_prefix + ".json\n")
+
+'''
+The functions below are used to reason about image footprints
+without calling out to Montage. Footprints are convex quadrilaterals
+on the plane tangent to the center of the output region.
+'''
+
+'''
+Function to project sky coordinates (degrees) onto the plane tangent
+to (ra0, dec0), returning plane coordinates in degrees
+'''
+def sky_to_plane(ra, dec, ra0, dec0):
+    ra = math.radians(ra)
+    dec = math.radians(dec)
+    ra0 = math.radians(ra0)
+    dec0 = math.radians(dec0)
+    cos_c = math.sin(dec0) * math.sin(dec) + \
+            math.cos(dec0) * math.cos(dec) * math.cos(ra - ra0)
+    x = math.cos(dec) * math.sin(ra - ra0) / cos_c
+    y = (math.cos(dec0) * math.sin(dec) - \
+         math.sin(dec0) * math.cos(dec) * math.cos(ra - ra0)) / cos_c
+    return (-math.degrees(x), math.degrees(y))
+
+'''
+Function to convert plane coordinates (degrees) back to sky coordinates,
+the inverse of sky_to_plane()
+'''
+def plane_to_sky(x, y, ra0, dec0):
+    x = -math.radians(x)
+    y = math.radians(y)
+    ra0 = math.radians(ra0)
+    dec0 = math.radians(dec0)
+    rho = math.hypot(x, y)
+    if rho == 0.0:
+        return (math.degrees(ra0), math.degrees(dec0))
+    c = math.atan(rho)
+    dec = math.asin(math.cos(c) * math.sin(dec0) + y * math.sin(c) * math.cos(dec0) / rho)
+    ra = ra0 + math.atan2(x * math.sin(c),
+                          rho * math.cos(dec0) * math.cos(c) - y * math.sin(dec0) * math.sin(c))
+    return (math.degrees(ra) % 360.0, math.degrees(dec))
+
+'''
+Function to get the four sky corners of an image from a row of a
+Montage image table. The ra1..dec4 columns are used when present,
+otherwise the corners are computed from the WCS columns
+'''
+def image_corners(row):
+    names = row.colnames if hasattr(row, 'colnames') else row.keys()
+    if all(('ra%d' % i) in names and ('dec%d' % i) in names for i in range(1, 5)):
+        return [(float(row['ra%d' % i]), float(row['dec%d' % i])) for i in range(1, 5)]
+
+    naxis1 = float(row['naxis1'])
+    naxis2 = float(row['naxis2'])
+    crpix1 = float(row['crpix1'])
+    crpix2 = float(row['crpix2'])
+    crval1 = float(row['crval1'])
+    crval2 = float(row['crval2'])
+    cdelt1 = float(row['cdelt1'])
+    cdelt2 = float(row['cdelt2'])
+    crota2 = math.radians(float(row['crota2'])) if 'crota2' in names else 0.0
+
+    corners = []
+    for (px, py) in [(0.5, 0.5), (naxis1 + 0.5, 0.5), (naxis1 + 0.5, naxis2 + 0.5), (0.5, naxis2 + 0.5)]:
+        dx = (px - crpix1) * cdelt1
+        dy = (py - crpix2) * cdelt2
+        x = dx * math.cos(crota2) - dy * math.sin(crota2)
+        y = dx * math.sin(crota2) + dy * math.cos(crota2)
+        corners.append(plane_to_sky(-x, y, crval1, crval2))
+    return corners
+
+'''
+Function to turn sky corners into a counter-clockwise convex polygon
+on the plane tangent to (ra0, dec0)
+'''
+def footprint_polygon(corners, ra0, dec0):
+    points = [sky_to_plane(ra, dec, ra0, dec0) for (ra, dec) in corners]
+    cx = sum(p[0] for p in points) / len(points)
+    cy = sum(p[1] for p in points) / len(points)
+    points.sort(key=lambda p: math.atan2(p[1] - cy, p[0] - cx))
+    return points
+
+'''
+Function to compute the area of a polygon (shoelace formula)
+'''
+def polygon_area(poly):
+    area = 0.0
+    for i in range(len(poly)):
+        (x1, y1) = poly[i]
+        (x2, y2) = poly[(i + 1) % len(poly)]
+        area += x1 * y2 - x2 * y1
+    return abs(area) / 2.0
+
+'''
+Function to intersect two counter-clockwise convex polygons
+(Sutherland-Hodgman clipping), returning the intersection polygon
+'''
+def clip_polygon(subject, clip):
+    output = list(subject)
+    for i in range(len(clip)):
+        if len(output) == 0:
+            break
+        (ax, ay) = clip[i]
+        (bx, by) = clip[(i + 1) % len(clip)]
+        inside = lambda p: (bx - ax) * (p[1] - ay) - (by - ay) * (p[0] - ax) >= 0.0
+        polygon = output
+        output = []
+        for j in range(len(polygon)):
+            current = polygon[j]
+            previous = polygon[j - 1]
+            if inside(current):
+                if not inside(previous):
+                    output.append(segment_intersection(previous, current, (ax, ay), (bx, by)))
+                output.append(current)
+            elif inside(previous):
+                output.append(segment_intersection(previous, current, (ax, ay), (bx, by)))
+    return output
+
+'''
+Function to intersect the segment p1-p2 with the line through a-b
+'''
+def segment_intersection(p1, p2, a, b):
+    (x1, y1) = p1
+    (x2, y2) = p2
+    (x3, y3) = a
+    (x4, y4) = b
+    denom = (x1 - x2) * (y3 - y4) - (y1 - y2) * (x3 - x4)
+    if denom == 0.0:
+        return p2
+    t = ((x1 - x3) * (y3 - y4) - (y1 - y3) * (x3 - x4)) / denom
+    return (x1 + t * (x2 - x1), y1 + t * (y2 - y1))
+
+'''
+Function to compute the overlap area of two convex polygons
+'''
+def overlap_area_of(poly1, poly2):
+    intersection = clip_polygon(poly1, poly2)
+    if len(intersection) < 3:
+        return 0.0
+    return polygon_area(intersection)
+
+'''
+Function to find all pairs of overlapping polygons. Polygon bounding
+boxes are hashed into a uniform grid whose cell size is the median
+bounding box size, so only polygons sharing a cell are compared exactly.
+Returns a sorted list of (i, j, area) with i < j
+'''
+def find_overlapping_pairs(polygons):
+    if len(polygons) == 0:
+        return []
+
+    boxes = []
+    for poly in polygons:
+        xs = [p[0] for p in poly]
+        ys = [p[1] for p in poly]
+        boxes.append((min(xs), min(ys), max(xs), max(ys)))
+
+    sizes = sorted(max(b[2] - b[0], b[3] - b[1]) for b in boxes)
+    cell = sizes[len(sizes) // 2]
+    if cell <= 0.0:
+        cell = 1.0
+
+    grid = {}
+    for (i, box) in enumerate(boxes):
+        for gx in range(int(math.floor(box[0] / cell)), int(math.floor(box[2] / cell)) + 1):
+            for gy in range(int(math.floor(box[1] / cell)), int(math.floor(box[3] / cell)) + 1):
+                grid.setdefault((gx, gy), []).append(i)
+
+    candidates = set()
+    for members in grid.values():
+        for a in range(len(members)):
+            for b in range(a + 1, len(members)):
+                candidates.add((members[a], members[b]))
+
+    pairs = []
+    for (i, j) in candidates:
+        (bi, bj) = (boxes[i], boxes[j])
+        if bi[2] < bj[0] or bj[2] < bi[0] or bi[3] < bj[1] or bj[3] < bi[1]:
+            continue
+        area = overlap_area_of(polygons[i], polygons[j])
+        if area > 0.0:
+            pairs.append((min(i, j), max(i, j), area))
+    pairs.sort()
+    return pairs
+
+'''
+Function to compute the footprints of all images of a Montage image
+table, on the plane tangent to the mean image center
+'''
+def table_footprints(data):
+    corners = [image_corners(row) for row in data]
+    if len(corners) == 0:
+        return (corners, [], 0.0, 0.0)
+    x = sum(math.cos(math.radians(dec)) * math.cos(math.radians(ra)) for c in corners for (ra, dec) in c)
+    y = sum(math.cos(math.radians(dec)) * math.sin(math.radians(ra)) for c in corners for (ra, dec) in c)
+    z = sum(math.sin(math.radians(dec)) for c in corners for (ra, dec) in c)
+    ra0 = math.degrees(math.atan2(y, x)) % 360.0
+    dec0 = math.degrees(math.atan2(z, math.hypot(x, y)))
+    polygons = [footprint_polygon(c, ra0, dec0) for c in corners]
+    return (corners, polygons, ra0, dec0)
+
+'''
+Function to replace mOverlaps: reads an image table, finds the overlapping
+image pairs with a spatial grid index, and writes a diffs table in the
+same format as mOverlaps. If with_area is True, an extra 'area' column
+holds the overlap area in square degrees
+'''
+def find_overlaps(images_tbl, diffs_tbl, with_area=False):
+    data = ascii.read(images_tbl)
+    (corners, polygons, ra0, dec0) = table_footprints(data)
+    pairs = find_overlapping_pairs(polygons)
+
+    if 'cntr' in data.colnames:
+        cntrs = [int(c) for c in data['cntr']]
+    else:
+        cntrs = list(range(len(data)))
+
+    t = Table()
+    t['cntr1'] = [cntrs[i] for (i, j, area) in pairs]
+    t['cntr2'] = [cntrs[j] for (i, j, area) in pairs]
+    t['plus'] = [str(data[i]['file']) for (i, j, area) in pairs]
+    t['minus'] = [str(data[j]['file']) for (i, j, area) in pairs]
+    t['diff'] = ['diff.%06d.%06d.fits' %(cntrs[i], cntrs[j]) for (i, j, area) in pairs]
+    if with_area:
+        t['area'] = [area for (i, j, area) in pairs]
+    ascii.write(t, diffs_tbl, format='ipac', overwrite=True)
+
+    return len(pairs)
+
+'''
+Function to compute the smallest non-zero eigenvalue of the weighted
+Laplacian of an overlap graph. The background solve is a least-squares
+problem on this graph, so the inverse of this eigenvalue bounds how much
+noise in the individual fits is amplified in the solution
+'''
+def laplacian_gap(n, edges):
+    laplacian = np.zeros((n, n))
+    for (i, j, w) in edges:
+        laplacian[i, i] += w
+        laplacian[j, j] += w
+        laplacian[i, j] -= w
+        laplacian[j, i] -= w
+    eigenvalues = np.linalg.eigvalsh(laplacian)
+    tolerance = 1e-12 * max(1.0, eigenvalues[-1])
+    nonzero = [e for e in eigenvalues if e > tolerance]
+    if len(nonzero) == 0:
+        return 0.0
+    return nonzero[0]
+
+'''
+Function to prune a diffs table: keeps a maximum spanning forest of the
+overlap graph (weighted by overlap area), so every connected group of
+images stays connected, plus the keep_per_image largest overlaps of each
+image. Rewrites the diffs table in place and returns (kept, dropped)
+'''
+def prune_overlaps(images_tbl, diffs_tbl, keep_per_image):
+    images = ascii.read(images_tbl)
+    diffs = ascii.read(diffs_tbl)
+
+    if 'cntr' in images.colnames:
+        index = dict((int(c), i) for (i, c) in enumerate(images['cntr']))
+    else:
+        index = dict((i, i) for i in range(len(images)))
+
+    if 'area' in diffs.colnames:
+        areas = [float(a) for a in diffs['area']]
+    else:
+        (corners, polygons, ra0, dec0) = table_footprints(images)
+        areas = [overlap_area_of(polygons[index[int(row['cntr1'])]], polygons[index[int(row['cntr2'])]])
+                 for row in diffs]
+
+    edges = [(index[int(row['cntr1'])], index[int(row['cntr2'])], areas[k])
+             for (k, row) in enumerate(diffs)]
+
+    # maximum spanning forest (Kruskal)
+    parent = list(range(len(images)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    keep = set()
+    for k in sorted(range(len(edges)), key=lambda k: -edges[k][2]):
+        (ri, rj) = (find(edges[k][0]), find(edges[k][1]))
+        if ri != rj:
+            parent[ri] = rj
+            keep.add(k)
+
+    # top-k overlaps per image
+    per_image = {}
+    for (k, (i, j, area)) in enumerate(edges):
+        per_image.setdefault(i, []).append(k)
+        per_image.setdefault(j, []).append(k)
+    for ks in per_image.values():
+        ks.sort(key=lambda k: -edges[k][2])
+        keep.update(ks[:keep_per_image])
+
+    kept_rows = sorted(keep)
+    dropped = len(edges) - len(kept_rows)
+    sys.stderr.write('\tPruned overlap graph: kept %d of %d overlaps (dropped %d)\n'
+                     %(len(kept_rows), len(edges), dropped))
+
+    if dropped > 0 and len(images) <= 3000:
+        full_gap = laplacian_gap(len(images), edges)
+        pruned_gap = laplacian_gap(len(images), [edges[k] for k in kept_rows])
+        if pruned_gap > 0.0:
+            sys.stderr.write('\tBackground noise amplification bound: %.2fx the unpruned solve\n'
+                             %(full_gap / pruned_gap))
+
+    diffs = diffs[kept_rows]
+    ascii.write(diffs, diffs_tbl, format='ipac', overwrite=True)
+
+    return (len(kept_rows), dropped)
+
+'''
+Function to read a Montage header template (such as region.hdr) into a
+dictionary with lower-case keys, the same keys as an image table row
+'''
+def read_hdr(path):
+    header = {}
+    with open(path) as f:
+        for line in f:
+            if '=' not in line:
+                continue
+            (key, value) = line.split('=', 1)
+            value = value.split('/')[0].strip().strip('\'').strip()
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+            header[key.strip().lower()] = value
+    return header
+
+'''
+Function to drop the images of an image table that cannot contribute
+to the final mosaic. An image is kept if its footprint intersects the
+region, or if it overlaps an image that does (so that the background
+matching of the region's images is unchanged). Rewrites the image table
+in place and returns the number of images dropped
+'''
+def cull_image_table(images_tbl, region_hdr):
+    data = ascii.read(images_tbl)
+    region = read_hdr(region_hdr)
+    ra0 = float(region['crval1'])
+    dec0 = float(region['crval2'])
+
+    polygons = [footprint_polygon(image_corners(row), ra0, dec0) for row in data]
+    polygons.append(footprint_polygon(image_corners(region), ra0, dec0))
+    region_id = len(polygons) - 1
+
+    neighbors = {}
+    for (i, j, area) in find_overlapping_pairs(polygons):
+        neighbors.setdefault(i, set()).add(j)
+        neighbors.setdefault(j, set()).add(i)
+
+    inside = neighbors.get(region_id, set())
+    keep = set(inside)
+    for i in inside:
+        keep.update(neighbors.get(i, set()))
+    keep.discard(region_id)
+
+    dropped = len(data) - len(keep)
+    if dropped > 0:
+        data = data[sorted(keep)]
+        ascii.write(data, images_tbl, format='ipac', overwrite=True)
+    return dropped
+
+'''
+Function to compute which of the given plane points lie inside a
+counter-clockwise convex polygon, as a boolean array
+'''
+def points_in_polygon(xs, ys, poly):
+    inside = np.ones(len(xs), dtype=bool)
+    for i in range(len(poly)):
+        (ax, ay) = poly[i]
+        (bx, by) = poly[(i + 1) % len(poly)]
+        inside &= (bx - ax) * (ys - ay) - (by - ay) * (xs - ax) >= 0.0
+    return inside
+
+'''
+Function to select a subset of the images of an image table that still
+covers the region depth times. The region is sampled on a grid and images
+are picked greedily by the number of under-covered samples they cover,
+multiplied by the weight column if one is given. Rewrites the image table
+in place and returns the number of images dropped
+'''
+def select_covering_images(images_tbl, region_hdr, depth, weight_column=None, samples=100):
+    data = ascii.read(images_tbl)
+    region = read_hdr(region_hdr)
+    ra0 = float(region['crval1'])
+    dec0 = float(region['crval2'])
+
+    region_poly = footprint_polygon(image_corners(region), ra0, dec0)
+    xmin = min(p[0] for p in region_poly)
+    xmax = max(p[0] for p in region_poly)
+    ymin = min(p[1] for p in region_poly)
+    ymax = max(p[1] for p in region_poly)
+    (gx, gy) = np.meshgrid(np.linspace(xmin, xmax, samples), np.linspace(ymin, ymax, samples))
+    (xs, ys) = (gx.ravel(), gy.ravel())
+    in_region = points_in_polygon(xs, ys, region_poly)
+    (xs, ys) = (xs[in_region], ys[in_region])
+
+    coverage = [points_in_polygon(xs, ys, footprint_polygon(image_corners(row), ra0, dec0))
+                for row in data]
+    if weight_column != None:
+        weights = [float(w) for w in data[weight_column]]
+    else:
+        weights = [1.0] * len(data)
+
+    need = np.full(len(xs), depth)
+    selected = []
+    remaining = set(range(len(data)))
+    while len(remaining) > 0 and need.max() > 0:
+        best = None
+        best_gain = 0.0
+        for i in remaining:
+            gain = weights[i] * np.count_nonzero(coverage[i] & (need > 0))
+            if gain > best_gain:
+                (best, best_gain) = (i, gain)
+        if best == None:
+            break
+        selected.append(best)
+        remaining.discard(best)
+        need[coverage[best]] -= 1
+
+    dropped = len(data) - len(selected)
+    if dropped > 0:
+        data = data[sorted(selected)]
+        ascii.write(data, images_tbl, format='ipac', overwrite=True)
+    return dropped
+
+'''
+Function to check whether the pair of CTYPE values is a plain TAN
+projection, which mProjectPP can handle
+'''
+def is_tan(ctype1, ctype2):
+    tan = ('-TAN', '-TAN-SIP')
+    return str(ctype1).strip().upper().endswith(tan) and str(ctype2).strip().upper().endswith(tan)
+
+'''
+Function to choose the projection executable for an input image. The
+output templates are always TAN, so the plane-to-plane mProjectPP can be
+used whenever the input is TAN too. The image header is used if the file
+has already been downloaded, otherwise the image table's CTYPEs are used
+'''
+def choose_projector(row, survey, in_fits):
+    path = os.path.join('data', in_fits)
+    if os.path.isfile(path):
+        header = fits.getheader(path)
+        # DSS plates carry a plate solution that only mProject understands
+        if 'PLTRAH' in header:
+            return 'mProject'
+        if is_tan(header.get('CTYPE1', ''), header.get('CTYPE2', '')):
+            return 'mProjectPP'
+        return 'mProject'
+
+    if survey.lower() == 'dss':
+        return 'mProject'
+    if 'ctype1' in row.colnames and 'ctype2' in row.colnames and is_tan(row['ctype1'], row['ctype2']):
+        return 'mProjectPP'
+    return 'mProject'
+
+'''
+The functions below implement an in-process replacement for mProject.
+Output pixels are mapped to input pixels with astropy WCS, and the
+mapping (indices and bilinear weights) is cached per (input WCS, output
+template) pair so that plates sharing the same geometry reuse it.
+'''
+
+projection_cache_size = 16
+
+'''
+Least recently used cache of pixel mappings, shared by the threads of a
+worker. Its operations are single OrderedDict calls, which the GIL keeps
+atomic, so entries evicted by another thread are simply missed
+'''
+class ProjectionCache:
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    '''
+    Method to get a mapping, or None if it is not cached
+    '''
+    def get(self, key):
+        try:
+            mapping = self.entries[key]
+            self.entries.move_to_end(key)
+        except KeyError:
+            return None
+        return mapping
+
+    '''
+    Method to add a mapping, evicting the least recently used ones
+    '''
+    def put(self, key, mapping):
+        self.entries[key] = mapping
+        while len(self.entries) > self.size:
+            try:
+                self.entries.popitem(last=False)
+            except KeyError:
+                break
+
+# the cache used outside of Dask workers
+projection_cache = ProjectionCache(projection_cache_size)
+
+'''
+Function to get the projection cache of the current Dask worker. It is
+kept on the worker itself: the globals of this script are copied into
+every task when it runs as __main__, so a global cache would only be
+shared by the images of one task
+'''
+def worker_projection_cache():
+    try:
+        worker = get_worker()
+    except ValueError:
+        return projection_cache
+    return vars(worker).setdefault('montage_projection_cache', ProjectionCache(projection_cache_size))
+
+'''
+Function to compute (or fetch from the cache) the pixel mapping from an
+input image to the output template
+'''
+def projection_mapping(in_header, out_header, template):
+    in_wcs = WCS(in_header).celestial
+    naxis1 = int(in_header['NAXIS1'])
+    naxis2 = int(in_header['NAXIS2'])
+    key = (in_wcs.to_header_string(relax=True), naxis1, naxis2, template)
+    cache = worker_projection_cache()
+    mapping = cache.get(key)
+    if mapping != None:
+        return mapping
+
+    out_wcs = WCS(out_header).celestial
+    out_naxis1 = int(out_header['NAXIS1'])
+    out_naxis2 = int(out_header['NAXIS2'])
+
+    # bounding box of the input footprint in output pixels, from its border
+    edge_x = np.linspace(-0.5, naxis1 - 0.5, 64)
+    edge_y = np.linspace(-0.5, naxis2 - 0.5, 64)
+    border_x = np.concatenate([edge_x, np.full(64, naxis1 - 0.5), edge_x, np.full(64, -0.5)])
+    border_y = np.concatenate([np.full(64, -0.5), edge_y, np.full(64, naxis2 - 0.5), edge_y])
+    (ra, dec) = in_wcs.all_pix2world(border_x, border_y, 0)
+    (ox, oy) = out_wcs.all_world2pix(ra, dec, 0)
+    x0 = max(0, int(np.floor(np.nanmin(ox))))
+    x1 = min(out_naxis1, int(np.ceil(np.nanmax(ox))) + 1)
+    y0 = max(0, int(np.floor(np.nanmin(oy))))
+    y1 = min(out_naxis2, int(np.ceil(np.nanmax(oy))) + 1)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError('image does not overlap the output template')
+
+    # input pixel coordinates of every output pixel of the bounding box
+    (gx, gy) = np.meshgrid(np.arange(x0, x1, dtype=float), np.arange(y0, y1, dtype=float))
+    (ra, dec) = out_wcs.all_pix2world(gx, gy, 0)
+    (ix, iy) = in_wcs.all_world2pix(ra, dec, 0)
+    valid = (ix >= 0) & (ix <= naxis1 - 1) & (iy >= 0) & (iy <= naxis2 - 1)
+    ix = np.where(valid, ix, 0.0)
+    iy = np.where(valid, iy, 0.0)
+    i0 = np.minimum(np.floor(ix).astype(np.int64), naxis1 - 2)
+    j0 = np.minimum(np.floor(iy).astype(np.int64), naxis2 - 2)
+    fx = ix - i0
+    fy = iy - j0
+    index = j0 * naxis1 + i0
+    indices = (index, index + 1, index + naxis1, index + naxis1 + 1)
+    weights = ((1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy)
+
+    mapping = ((x0, x1, y0, y1), indices, weights, valid)
+    cache.put(key, mapping)
+    return mapping
+
+'''
+Function to reproject one image onto the output template, writing the
+projected image and its area image like mProject does
+'''
+def reproject_plate(plane, in_fits, out_fits, out_header, template):
+    with fits.open(plane.path(in_fits)) as hdus:
+        in_header = hdus[0].header
+        if not WCS(in_header).has_celestial:
+            # not a WCS we can handle (e.g. a DSS plate solution): use mProject
+            cmd = 'mProject -X -z 0.1 %s %s %s' %(in_fits, out_fits, template)
+            if subprocess.call(cmd, shell=True, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               cwd=plane.data_dir) != 0:
+                raise RuntimeError('command ' + cmd + ' failed')
+            return
+        data = hdus[0].data.astype(pixel_type)
+        ((x0, x1, y0, y1), indices, weights, valid) = projection_mapping(in_header, out_header, template)
+
+    flat = data.ravel()
+    projected = sum(w * flat[i] for (i, w) in zip(indices, weights))
+    projected[~valid] = np.nan
+    projected = projected.astype(pixel_type)
+
+    header = out_header.copy()
+    header['NAXIS1'] = x1 - x0
+    header['NAXIS2'] = y1 - y0
+    header['CRPIX1'] = float(out_header['CRPIX1']) - x0
+    header['CRPIX2'] = float(out_header['CRPIX2']) - y0
+
+    pixel_area = abs(float(out_header['CDELT1']) * float(out_header['CDELT2'])) * (math.pi / 180.0) ** 2
+    area = np.where(valid, pixel_area, 0.0).astype(pixel_type)
+
+    plane.write(out_fits, projected, header)
+    plane.write(re.sub('\\.fits', '_area.fits', out_fits), area, header)
+
+'''
+Function implementing the mProjectPy in-process executable: reprojects
+several images onto the same template in one call. Arguments are the
+data plane, the template and then (input, output) file pairs
+'''
+def reproject_plates(plane, template, *pairs):
+    out_header = fits.Header.fromtextfile(plane.path(template))
+    for k in range(0, len(pairs), 2):
+        reproject_plate(plane, pairs[k], pairs[k + 1], out_header, template)
+
+in_process_executables['mProjectPy'] = reproject_plates
+
+'''
+Function implementing the mBackgroundPy in-process executable, with the
+same arguments as 'mBackground -t': subtracts the plane correction of
+the image (looked up in the corrections table through the image's id in
+the image table) from a projected image, and copies its area image
+'''
+def background_correct(plane, flag, in_fits, out_fits, images_tbl, corrections_tbl):
+    images = ascii.read(plane.path(images_tbl))
+    corrections = ascii.read(plane.path(corrections_tbl))
+
+    image = [row for row in images if os.path.basename(str(row['file'])) == in_fits][0]
+    correction = [row for row in corrections if int(row['id']) == int(image['cntr'])]
+    if len(correction) > 0:
+        (a, b, c) = (float(correction[0]['a']), float(correction[0]['b']), float(correction[0]['c']))
+    else:
+        (a, b, c) = (0.0, 0.0, 0.0)
+
+    (data, header) = plane.read(in_fits)
+    # the plane is relative to the reference pixel of the projected image
+    # itself, as in mBackground, not to the one of the image table
+    crpix1 = float(header['CRPIX1'])
+    crpix2 = float(header['CRPIX2'])
+    x = np.arange(data.shape[1]) + 1.0 - crpix1
+    y = np.arange(data.shape[0]) + 1.0 - crpix2
+    corrected = (data - (a * x[np.newaxis, :] + b * y[:, np.newaxis] + c)).astype(pixel_type)
+    plane.write(out_fits, corrected, header)
+
+    in_area = re.sub('\\.fits', '_area.fits', in_fits)
+    (area, area_header) = plane.read(in_area)
+    plane.write(re.sub('\\.fits', '_area.fits', out_fits), area, area_header)
+
+in_process_executables['mBackgroundPy'] = background_correct
+
+'''
+Function implementing the mCompressPy in-process executable: writes an
+image as tile-compressed FITS. The compression is 'rice' (Rice on
+integer-scaled pixels), 'gzip' (GZIP on integer-scaled pixels) or
+'lossless' (GZIP with shuffled bytes on the unquantized pixels)
+'''
+def compress_mosaic(plane, in_fits, out_fits, compression, tile=256):
+    (data, header) = plane.read(in_fits)
+    if compression == 'rice':
+        options = {'compression_type': 'RICE_1', 'quantize_level': 16.0}
+    elif compression == 'gzip':
+        options = {'compression_type': 'GZIP_1', 'quantize_level': 16.0}
+    else:
+        options = {'compression_type': 'GZIP_2', 'quantize_level': 0.0}
+
+    try:
+        hdu = fits.CompImageHDU(data, header, tile_shape=(tile, tile), **options)
+    except TypeError:
+        # astropy < 5.3
+        hdu = fits.CompImageHDU(data, header, tile_size=(tile, tile), **options)
+    hdu.writeto(plane.path(out_fits), overwrite=True)
+
+in_process_executables['mCompressPy'] = compress_mosaic
+
+'''
+Function to read a (compressed or not) mosaic. Only the tiles overlapping
+the requested rows and columns are decompressed. With header=True,
+returns (data, header) like fits.getdata does
+'''
+def read_mosaic(path, rows=slice(None), cols=slice(None), header=False):
+    with fits.open(path) as hdus:
+        hdu = hdus[1] if isinstance(hdus[-1], fits.CompImageHDU) else hdus[0]
+        data = np.array(hdu.section[rows, cols])
+        if header:
+            return (data, hdu.header.copy())
+        return data
+
+'''
+Function to write an 8-bit grayscale (2-d) array, or a 3-d array of
+grayscale and alpha, RGB or RGBA pixels, as a PNG file. Rows are written
+top to bottom, so FITS images should be flipped
+'''
+def write_png(path, pixels):
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    (height, width) = pixels.shape[:2]
+    channels = pixels.shape[2] if pixels.ndim == 3 else 1
+    # PNG color types of gray, gray and alpha, RGB and RGBA pixels
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+    # every row starts with filter type 0 (none)
+    raw = np.zeros((height, 1 + pixels[0].size), dtype=np.uint8)
+    raw[:, 1:] = pixels.reshape(height, -1)
+
+    def chunk(kind, payload):
+        return struct.pack('>I', len(payload)) + kind + payload + \
+               struct.pack('>I', zlib.crc32(kind + payload) & 0xffffffff)
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+'''
+Function to downsample an image by 2 in both directions, averaging the
+finite pixels of each 2x2 block
+'''
+def downsample(image):
+    (ny, nx) = image.shape
+    padded = np.full((ny + ny % 2, nx + nx % 2), np.nan)
+    padded[:ny, :nx] = image
+    blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+    finite = np.isfinite(blocks)
+    count = finite.sum(axis=(1, 3))
+    total = np.where(finite, blocks, 0.0).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+'''
+Function implementing the mTilePyramidPy in-process executable: cuts a
+mosaic into a z/x/y tile pyramid (PNG or FITS tiles, y counted from the
+top). The pyramid is built on the mosaic flipped top to bottom, so that
+the tiles, and the 2x2 blocks averaged into the lower levels, start at
+the top left corner; the partial tiles of the bottom and right edges are
+padded to the full size with NaN (transparent in PNG tiles). The
+memory-mapped mosaic is read once, in strips of two rows of tiles, to
+write the full-resolution tiles and build the half-resolution level:
+the strips having an even height, that is the same as downsampling the
+whole level. Every lower level is then built from the level above it.
+Tiles are written by a pool of threads
+'''
+def build_tile_pyramid(plane, mosaic_fits, tiles_dir, tile_format, tile):
+    tile = int(tile)
+    tiles_dir = plane.path(tiles_dir)
+    with fits.open(plane.path(mosaic_fits), memmap=True) as hdus:
+        mosaic = hdus[0].data
+        (ny, nx) = mosaic.shape
+        zmax = max(0, int(math.ceil(math.log2(max(nx, ny) / float(tile)))))
+
+        # stretch for PNG tiles, from a sample of the mosaic
+        sample = np.asarray(mosaic[::max(1, ny // 512), ::max(1, nx // 512)], dtype=np.float64)
+        sample = sample[np.isfinite(sample)]
+        (lo, hi) = np.percentile(sample, [0.5, 99.5]) if sample.size > 0 else (0.0, 1.0)
+
+        def write_tile(z, x, y, pixels):
+            padded = np.full((tile, tile), np.nan)
+            padded[:pixels.shape[0], :pixels.shape[1]] = pixels
+            path = os.path.join(tiles_dir, str(z), str(x))
+            os.makedirs(path, exist_ok=True)
+            if tile_format == 'fits':
+                # back to FITS order, the first row at the bottom
+                fits.writeto(os.path.join(path, '%d.fits' %(y)), padded[::-1].astype(np.float32), overwrite=True)
+            else:
+                scaled = np.clip((np.nan_to_num(padded, nan=lo) - lo) / max(hi - lo, 1e-30), 0.0, 1.0)
+                alpha = np.where(np.isfinite(padded), 255, 0)
+                write_png(os.path.join(path, '%d.png' %(y)), np.dstack([scaled * 255.0, alpha]))
+
+        def cut_level(pool, z, image, row0):
+            # image holds the rows row0.. of level z, counted from the top
+            futures = []
+            for r in range(0, image.shape[0], tile):
+                for c in range(0, image.shape[1], tile):
+                    futures.append(pool.submit(write_tile, z, c // tile, (row0 + r) // tile,
+                                               image[r:r + tile, c:c + tile]))
+            return futures
+
+        with ThreadPoolExecutor(max_workers=pyramid_threads) as pool:
+            # single pass over the full-resolution mosaic, from the top,
+            # writing the tiles of a strip while the next one is read
+            strips = []
+            pending = []
+            for r in range(0, ny, 2 * tile):
+                strip = np.array(mosaic[max(0, ny - r - 2 * tile):ny - r][::-1], dtype=np.float64)
+                for future in pending:
+                    future.result()
+                pending = cut_level(pool, zmax, strip, r)
+                if zmax > 0:
+                    strips.append(downsample(strip))
+
+            # lower resolution levels, in memory
+            for z in range(zmax - 1, -1, -1):
+                level = np.concatenate(strips)
+                pending += cut_level(pool, z, level, 0)
+                strips = [downsample(level)]
+            for future in pending:
+                future.result()
+
+in_process_executables['mTilePyramidPy'] = build_tile_pyramid
+
+'''
+The functions below implement an in-process replacement for mViewer.
+The stretch statistics of a mosaic are computed in one chunked pass over
+the memory-mapped file and saved next to it, so that the color composite
+reuses the statistics of each band instead of reading the mosaics again.
+'''
+
+'''
+Function to get the name of the statistics file of a mosaic
+'''
+def statistics_file(mosaic_fits):
+    return re.sub('\\.fits$', '.stats.json', mosaic_fits)
+
+'''
+Function to compute the statistics of a mosaic in a single chunked pass:
+mean and extrema over all the finite pixels, and quantiles from a
+regular sample of about max_samples pixels. Sigma is taken from the
+quantiles, as the 84.13% value minus the median like mViewer does, so
+that bright stars don't inflate it
+'''
+def mosaic_statistics(mosaic_fits, chunk_rows=512, max_samples=1000000):
+    with fits.open(mosaic_fits, memmap=True) as hdus:
+        mosaic = hdus[0].data
+        step = max(1, mosaic.size // max_samples)
+        (count, total) = (0, 0.0)
+        (low, high) = (np.inf, -np.inf)
+        samples = []
+        for r in range(0, mosaic.shape[0], chunk_rows):
+            chunk = np.asarray(mosaic[r:r + chunk_rows], dtype=np.float64).ravel()
+            chunk = chunk[np.isfinite(chunk)]
+            if chunk.size == 0:
+                continue
+            count += chunk.size
+            total += chunk.sum()
+            low = min(low, chunk.min())
+            high = max(high, chunk.max())
+            samples.append(chunk[::step])
+
+    if count == 0:
+        return {'count': 0, 'min': 0.0, 'max': 0.0, 'mean': 0.0, 'sigma': 0.0, 'quantiles': [0.0, 0.0]}
+    quantiles = np.quantile(np.concatenate(samples), np.linspace(0.0, 1.0, 1001))
+    return {
+        'count': count,
+        'min': float(low),
+        'max': float(high),
+        'mean': float(total / count),
+        'sigma': float(quantiles[841] - quantiles[500]),
+        'quantiles': [float(q) for q in quantiles],
+    }
+
+'''
+Function to get the statistics of a mosaic, from its statistics file
+if it was already computed
+'''
+def load_statistics(mosaic_fits):
+    path = statistics_file(mosaic_fits)
+    if os.path.isfile(path):
+        with open(path) as f:
+            return json.load(f)
+    return mosaic_statistics(mosaic_fits)
+
+'''
+Function to turn an mViewer range value ('max', 'min', '-1s' for one
+sigma below the median, '99.5%' for a percentile, or a number) into a
+pixel value
+'''
+def range_value(value, stats):
+    quantiles = stats['quantiles']
+    median = quantiles[len(quantiles) // 2]
+    if value == 'max':
+        return stats['max']
+    if value == 'min':
+        return stats['min']
+    if value.endswith('s'):
+        return median + float(value[:-1]) * stats['sigma']
+    if value.endswith('%'):
+        return float(np.interp(float(value[:-1]) / 100.0, np.linspace(0.0, 1.0, len(quantiles)), quantiles))
+    return float(value)
+
+'''
+Function to build the lookup table (pixel values, gray levels in [0, 1])
+of an mViewer stretch. The gaussian stretches equalize the histogram to a
+gaussian; a log does not change a histogram equalization, so gaussian-log
+is rendered like gaussian
+'''
+def stretch_table(stats, lo, hi, mode):
+    lo = range_value(lo, stats)
+    hi = max(range_value(hi, stats), lo + 1e-30)
+    if mode == 'linear':
+        return ([lo, hi], [0.0, 1.0])
+    if mode == 'log':
+        values = np.linspace(lo, hi, 256)
+        return (values, np.log1p(999.0 * (values - lo) / (hi - lo)) / math.log(1000.0))
+
+    # keep the quantiles between lo and hi, ranked by their position
+    quantiles = np.array(stats['quantiles'])
+    ranks = np.linspace(0.0, 1.0, len(quantiles))
+    inside = (quantiles > lo) & (quantiles < hi)
+    values = np.concatenate([[lo], quantiles[inside], [hi]])
+    (rank_lo, rank_hi) = np.interp([lo, hi], quantiles, ranks)
+    ranks = np.concatenate([[rank_lo], ranks[inside], [rank_hi]])
+    ranks = (ranks - rank_lo) / max(rank_hi - rank_lo, 1e-12)
+    normal = statistics.NormalDist()
+    levels = [(normal.inv_cdf(min(max(r, 0.001), 0.999)) + 3.0) / 6.0 for r in ranks]
+    # np.interp needs increasing pixel values
+    (values, unique) = np.unique(values, return_index=True)
+    return (values, np.clip(np.array(levels)[unique], 0.0, 1.0))
+
+'''
+Function to render a mosaic through a stretch table into 8-bit levels,
+in row chunks processed by a pool of threads. Rows are flipped for PNG
+'''
+def render_channel(mosaic_fits, table, chunk_rows=512):
+    (values, levels) = table
+    with fits.open(mosaic_fits, memmap=True) as hdus:
+        mosaic = hdus[0].data
+        out = np.zeros(mosaic.shape, dtype=np.uint8)
+
+        def render_chunk(r):
+            chunk = np.asarray(mosaic[r:r + chunk_rows], dtype=np.float64)
+            gray = np.interp(np.nan_to_num(chunk, nan=values[0]), values, levels)
+            out[r:r + chunk_rows] = (gray * 255.0 + 0.5).astype(np.uint8)
+
+        with ThreadPoolExecutor(max_workers=render_threads) as pool:
+            list(pool.map(render_chunk, range(0, mosaic.shape[0], chunk_rows)))
+    return out[::-1]
+
+'''
+Function implementing the mViewerPy in-process executable. It accepts
+the mViewer arguments used by this workflow: '-ct N', '-gray f lo hi mode'
+or '-red/-green/-blue f lo hi mode', and '-png out'
+'''
+def render_png(plane, *args):
+    channels = {}
+    png = None
+    k = 0
+    while k < len(args):
+        if args[k] == '-ct':
+            k += 2
+        elif args[k] in ('-gray', '-red', '-green', '-blue'):
+            channels[args[k]] = args[k + 1:k + 5]
+            k += 5
+        elif args[k] == '-png':
+            png = args[k + 1]
+            k += 2
+        else:
+            raise ValueError('unsupported mViewer argument ' + args[k])
+
+    png = plane.path(png)
+    if '-gray' in channels:
+        (f, lo, hi, mode) = channels['-gray']
+        f = plane.path(f)
+        stats = mosaic_statistics(f)
+        with open(statistics_file(f), 'w') as out:
+            json.dump(stats, out)
+        write_png(png, render_channel(f, stretch_table(stats, lo, hi, mode)))
+        return
+
+    rgb = []
+    for color in ('-red', '-green', '-blue'):
+        (f, lo, hi, mode) = channels[color]
+        f = plane.path(f)
+        rgb.append(render_channel(f, stretch_table(load_statistics(f), lo, hi, mode)))
+    write_png(png, np.stack(rgb, axis=-1))
+
+in_process_executables['mViewerPy'] = render_png
+
+'''
+The functions below implement the progressive co-addition: the region is
+split into tiles which are co-added separately, center first, and pasted
+into the mosaic one at a time, refreshing a preview PNG after each tile.
+'''
+
+'''
+Function to split region.hdr into n x n tile templates, written to
+data/, returning (template, x0, y0) for each tile, the ones closest to
+the center of the region first
+'''
+def region_tiles(n):
+    region = read_hdr('data/region.hdr')
+    naxis1 = int(region['naxis1'])
+    naxis2 = int(region['naxis2'])
+    with open('data/region.hdr') as f:
+        lines = [line for line in f if line.split('=')[0].strip() not in
+                 ('NAXIS1', 'NAXIS2', 'CRPIX1', 'CRPIX2', 'END')]
+
+    tiles = []
+    for i in range(n):
+        for j in range(n):
+            (x0, x1) = (naxis1 * i // n, naxis1 * (i + 1) // n)
+            (y0, y1) = (naxis2 * j // n, naxis2 * (j + 1) // n)
+            tile_hdr = 'region-tile.%d.%d.hdr' %(i, j)
+            with open(os.path.join('data', tile_hdr), 'w') as f:
+                f.writelines(lines[:3])
+                f.write('NAXIS1  = %d\n' %(x1 - x0))
+                f.write('NAXIS2  = %d\n' %(y1 - y0))
+                f.writelines(lines[3:])
+                f.write('CRPIX1  = %.6f\n' %(float(region['crpix1']) - x0))
+                f.write('CRPIX2  = %.6f\n' %(float(region['crpix2']) - y0))
+                f.write('END\n')
+            distance = math.hypot((x0 + x1) / 2.0 - naxis1 / 2.0, (y0 + y1) / 2.0 - naxis2 / 2.0)
+            tiles.append((distance, tile_hdr, x0, y0))
+    tiles.sort()
+    return [(tile_hdr, x0, y0) for (distance, tile_hdr, x0, y0) in tiles]
+
+'''
+Function implementing the mTileTblPy in-process executable: splits an
+image table into one table per tile template, keeping the images whose
+footprint overlaps the tile. Arguments are the image table and then
+(template, output table) pairs
+'''
+def split_image_table(plane, images_tbl, *pairs):
+    data = ascii.read(plane.path(images_tbl))
+    for k in range(0, len(pairs), 2):
+        tile = read_hdr(plane.path(pairs[k]))
+        ra0 = float(tile['crval1'])
+        dec0 = float(tile['crval2'])
+        tile_poly = footprint_polygon(image_corners(tile), ra0, dec0)
+        keep = [i for (i, row) in enumerate(data)
+                if overlap_area_of(footprint_polygon(image_corners(row), ra0, dec0), tile_poly) > 0.0]
+        ascii.write(data[keep], plane.path(pairs[k + 1]), format='ipac', overwrite=True)
+
+in_process_executables['mTileTblPy'] = split_image_table
+
+'''
+Function implementing the mAddTilePy in-process executable: runs mAdd
+on a tile, with the same arguments, unless no image overlaps the tile,
+in which case it writes an empty tile (mAdd fails on an empty table)
+'''
+def add_tile(plane, flag, tile_tbl, tile_hdr, tile_fits):
+    if len(ascii.read(plane.path(tile_tbl))) > 0:
+        cmd = 'mAdd %s %s %s %s' %(flag, tile_tbl, tile_hdr, tile_fits)
+        if subprocess.call(cmd, shell=True, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                           cwd=plane.data_dir) != 0:
+            raise RuntimeError('command ' + cmd + ' failed')
+        return
+
+    header = fits.Header.fromtextfile(plane.path(tile_hdr))
+    shape = (int(header['NAXIS2']), int(header['NAXIS1']))
+    fits.writeto(plane.path(tile_fits), np.full(shape, np.nan), header, overwrite=True)
+    fits.writeto(plane.path(re.sub('\\.fits$', '_area.fits', tile_fits)), np.zeros(shape), header, overwrite=True)
+
+in_process_executables['mAddTilePy'] = add_tile
+command_executables.add('mAddTilePy')
+
+'''
+Function implementing the mPasteTilePy in-process executable: pastes a
+co-added tile (and its area) at (x0, y0) in the mosaic, creating the
+mosaic from region.hdr for the first tile, then refreshes the progress
+PNG. The marker argument is a file to write when done, or '-' for
+none, and mode is 'new' for the first tile, 'update' for the others
+'''
+def paste_tile(plane, tile_fits, mosaic_fits, x0, y0, marker, mode):
+    (x0, y0) = (int(x0), int(y0))
+    mosaic_area = plane.path(re.sub('\\.fits$', '_area.fits', mosaic_fits))
+    tile_area = re.sub('\\.fits$', '_area.fits', tile_fits)
+    mosaic_fits = plane.path(mosaic_fits)
+
+    for (tile, mosaic) in ((tile_fits, mosaic_fits), (tile_area, mosaic_area)):
+        (data, header) = plane.read(tile)
+        if mode == 'new':
+            region = fits.Header.fromtextfile(plane.path('region.hdr'))
+            blank = np.full((int(region['NAXIS2']), int(region['NAXIS1'])), np.nan, dtype=data.dtype)
+            fits.writeto(mosaic, blank, region, overwrite=True)
+        with fits.open(mosaic, mode='update', memmap=True) as hdus:
+            hdus[0].data[y0:y0 + data.shape[0], x0:x0 + data.shape[1]] = data
+
+    # refresh a reduced resolution preview of the partial mosaic
+    with fits.open(mosaic_fits, memmap=True) as hdus:
+        step = max(1, max(hdus[0].data.shape) // 1024)
+        partial = np.array(hdus[0].data[::step, ::step], dtype=np.float64)
+    finite = partial[np.isfinite(partial)]
+    if finite.size > 0:
+        (lo, hi) = np.percentile(finite, [1.0, 99.5])
+        scaled = np.clip((np.nan_to_num(partial, nan=lo) - lo) / max(hi - lo, 1e-30), 0.0, 1.0)
+        write_png(re.sub('\\.fits$', '-progress.png', mosaic_fits), (scaled[::-1] * 255.0).astype(np.uint8))
+
+    if marker != '-':
+        open(plane.path(marker), 'w').close()
+
+in_process_executables['mPasteTilePy'] = paste_tile
+
+'''
+The functions below support the incremental update of a mosaic.
+'''
+
+'''
+Function to check whether any of the given image table rows overlaps
+the tile template
+'''
+def tile_touched(tile_hdr, rows):
+    tile = read_hdr(tile_hdr)
+    ra0 = float(tile['crval1'])
+    dec0 = float(tile['crval2'])
+    tile_poly = footprint_polygon(image_corners(tile), ra0, dec0)
+    for row in rows:
+        if overlap_area_of(footprint_polygon(image_corners(row), ra0, dec0), tile_poly) > 0.0:
+            return True
+    return False
+
+'''
+Function implementing the mSaveStatePy in-process executable: saves the
+image file names and their background corrections, for the next update
+'''
+def save_state(plane, images_tbl, corrections_tbl, state_file):
+    images = ascii.read(plane.path(images_tbl))
+    corrections = dict((int(row['id']), row) for row in ascii.read(plane.path(corrections_tbl)))
+    t = Table(names=('file', 'a', 'b', 'c'), dtype=(str, float, float, float))
+    for row in images:
+        correction = corrections.get(int(row['cntr']))
+        if correction != None:
+            t.add_row((str(row['file']), float(correction['a']), float(correction['b']), float(correction['c'])))
+        else:
+            t.add_row((str(row['file']), 0.0, 0.0, 0.0))
+    ascii.write(t, plane.path(state_file), format='ipac', overwrite=True)
+
+in_process_executables['mSaveStatePy'] = save_state
+
+'''
+Function implementing the mBgModelPy in-process executable, with the
+arguments of mBgModel plus '-w state': solves for the plane corrections
+such that corrections[plus] - corrections[minus] matches every fit of
+the fits table, in the least-squares sense weighted by npixel. The images
+listed in the state file keep their previous corrections; the others
+start from zero and are solved by damped Jacobi iterations
+'''
+def background_model(plane, flag, niter, images_tbl, fits_tbl, corrections_tbl, *options):
+    images = ascii.read(plane.path(images_tbl))
+    fit_rows = ascii.read(plane.path(fits_tbl))
+    ids = [int(c) for c in images['cntr']]
+    index = dict((c, i) for (i, c) in enumerate(ids))
+
+    corrections = np.zeros((len(ids), 3))
+    fixed = np.zeros(len(ids), dtype=bool)
+    if len(options) == 2 and options[0] == '-w':
+        previous = dict((str(row['file']), (float(row['a']), float(row['b']), float(row['c'])))
+                        for row in ascii.read(plane.path(options[1])))
+        for (i, row) in enumerate(images):
+            if str(row['file']) in previous:
+                corrections[i] = previous[str(row['file'])]
+                fixed[i] = True
+
+    plus = np.array([index[int(p)] for p in fit_rows['plus']], dtype=int)
+    minus = np.array([index[int(m)] for m in fit_rows['minus']], dtype=int)
+    fit = np.array([[float(r['a']), float(r['b']), float(r['c'])] for r in fit_rows]).reshape(-1, 3)
+    weight = np.array([float(r['npixel']) if 'npixel' in fit_rows.colnames else 1.0 for r in fit_rows])
+    degree = np.bincount(plus, weight, len(ids)) + np.bincount(minus, weight, len(ids))
+
+    free = ~fixed & (degree > 0)
+    for iteration in range(int(niter)):
+        target = np.zeros((len(ids), 3))
+        for k in range(3):
+            target[:, k] = np.bincount(plus, weight * (corrections[minus, k] + fit[:, k]), len(ids)) + \
+                           np.bincount(minus, weight * (corrections[plus, k] - fit[:, k]), len(ids))
+        update = target[free] / degree[free, np.newaxis]
+        change = np.abs(update - corrections[free]).max() if np.any(free) else 0.0
+        corrections[free] = corrections[free] + (2.0 / 3.0) * (update - corrections[free])
+        if change < 1e-10:
+            break
+
+    # without any fixed image, the corrections are only defined up to a constant
+    if not np.any(fixed) and len(ids) > 0:
+        corrections -= corrections.mean(axis=0)
+
+    t = Table()
+    t['id'] = ids
+    t['a'] = corrections[:, 0]
+    t['b'] = corrections[:, 1]
+    t['c'] = corrections[:, 2]
+    ascii.write(t, plane.path(corrections_tbl), format='ipac', overwrite=True)
+
+in_process_executables['mBgModelPy'] = background_model
 
 '''
 The functions below are written by scientists to generate
@@ -253,18 +2195,26 @@ def generate_workflow(center, degrees, bands):
     return wf
 
 def generate_region_hdr(wf, center, degrees):
+    global pixel_type
+    global preview_scale
 
     (crval1, crval2) = center.split()
     crval1 = float(crval1)
     crval2 = float(crval2)
 
     cdelt = 0.000277778
+    # previews use coarser pixels, with the same angular padding
+    pad = 3000
+    if preview_scale != None:
+        cdelt *= preview_scale
+        pad = int(pad / preview_scale + 0.5)
     naxis = int((float(degrees) / cdelt) + 0.5)
     crpix = (naxis + 1) / 2.0
+    bitpix = -32 if pixel_type == 'float32' else -64
 
     f = open('data/region.hdr', 'w')
     f.write('SIMPLE  = T\n')
-    f.write('BITPIX  = -64\n')
+    f.write('BITPIX  = %d\n' %(bitpix))
     f.write('NAXIS   = 2\n')
     f.write('NAXIS1  = %d\n' %(naxis))
     f.write('NAXIS2  = %d\n' %(naxis))
@@ -287,16 +2237,16 @@ def generate_region_hdr(wf, center, degrees):
     f = open('data/region-oversized.hdr', 'w')
 
     f.write('SIMPLE  = T\n')
-    f.write('BITPIX  = -64\n')
+    f.write('BITPIX  = %d\n' %(bitpix))
     f.write('NAXIS   = 2\n')
-    f.write('NAXIS1  = %d\n' %(naxis + 3000))
-    f.write('NAXIS2  = %d\n' %(naxis + 3000))
+    f.write('NAXIS1  = %d\n' %(naxis + pad))
+    f.write('NAXIS2  = %d\n' %(naxis + pad))
     f.write('CTYPE1  = \'RA---TAN\'\n')
     f.write('CTYPE2  = \'DEC--TAN\'\n')
     f.write('CRVAL1  = %.6f\n' %(crval1))
     f.write('CRVAL2  = %.6f\n' %(crval2))
-    f.write('CRPIX1  = %.6f\n' %(crpix + 1500))
-    f.write('CRPIX2  = %.6f\n' %(crpix + 1500))
+    f.write('CRPIX1  = %.6f\n' %(crpix + pad / 2))
+    f.write('CRPIX2  = %.6f\n' %(crpix + pad / 2))
     f.write('CDELT1  = %.9f\n' %(-cdelt))
     f.write('CDELT2  = %.9f\n' %(cdelt))
     f.write('CROTA2  = %.6f\n' %(0.0))
@@ -307,6 +2257,24 @@ def generate_region_hdr(wf, center, degrees):
 
 def add_band(wf, band_id, center, degrees, survey, band, color):
     global verbose
+    global overlap_finder
+    global overlap_area
+    global prune_keep
+    global cull_images
+    global coverage_depth
+    global coverage_weight
+    global fast_project
+    global projection_engine
+    global projection_batch
+    global background_engine
+    global mosaic_compression
+    global tile_pyramid
+    global tile_size
+    global renderer
+    global preview_scale
+    global progressive_tiles
+    global update_mode
+    global archive_url
 
     if verbose:
         redirect = None
@@ -314,19 +2282,47 @@ def add_band(wf, band_id, center, degrees, survey, band, color):
         redirect = subprocess.DEVNULL
 
     band_id = str(band_id)
+    first_task = len(wf.tasks)
 
     sys.stderr.write('\tAdding band %s (%s %s -> %s)\n' %(band_id, survey, band, color))
 
     # data find - go a little bit outside the box - see mExec implentation
     degrees_datafind = str(float(degrees) * 1.42)
-    cmd = 'mArchiveList %s %s \'%s\' %s %s data/%s-images.tbl' \
-          %(survey, band, center, degrees_datafind, degrees_datafind, band_id)
+    if archive_url != None:
+        # a local archive, such as montage-workflow-eval/archive-emulator.py
+        query = urlencode({'survey': survey, 'band': band, 'center': center, 'size': degrees_datafind})
+        cmd = 'wget "%s/images.tbl?%s" -O data/%s-images.tbl' %(archive_url.rstrip('/'), query, band_id)
+    else:
+        cmd = 'mArchiveList %s %s \'%s\' %s %s data/%s-images.tbl' \
+              %(survey, band, center, degrees_datafind, degrees_datafind, band_id)
     if (verbose):
         sys.stderr.write('\tRunning sub command: ' + cmd + "\n")
     if subprocess.call(cmd, shell=True, stderr=redirect, stdout=redirect) != 0:
         sys.stderr.write('\tCommand ' + cmd + ' failed!')
         sys.exit(1)
 
+    # drop the images that never touch the final mosaic
+    if cull_images:
+        dropped = cull_image_table('data/%s-images.tbl' %(band_id), 'data/region.hdr')
+        sys.stderr.write('\tCulled %d images outside of the region\n' %(dropped))
+
+    # only keep the images needed to cover the region to the requested depth
+    if coverage_depth != None:
+        dropped = select_covering_images('data/%s-images.tbl' %(band_id), 'data/region.hdr',
+                                         coverage_depth, coverage_weight)
+        sys.stderr.write('\tDropped %d images redundant for coverage\n' %(dropped))
+
+    # in update mode, only the images that are new since the previous run
+    # (or whose products are gone) are projected, fitted and corrected.
+    # Previews, at another pixel scale, start from scratch
+    previous = None
+    if update_mode and preview_scale == None:
+        previous = load_previous_state(band_id)
+        if previous != None:
+            new_images = [f for f in ascii.read('data/%s-images.tbl' %(band_id))['file'] if f not in previous]
+            sys.stderr.write('\tUpdating with %d new images\n' %(len(new_images)))
+    is_new = lambda f: previous == None or f not in previous
+
     # image tables
     raw_tbl = '%s-raw.tbl' %(band_id)
     projected_tbl = '%s-projected.tbl' %(band_id)
@@ -338,111 +2334,180 @@ def add_band(wf, band_id, center, degrees, survey, band, color):
     if subprocess.call(cmd, shell=True, stderr=redirect, stdout=redirect) != 0:
         sys.stderr('\tCommand' + cmd + '  failed!\n')
         sys.exit(1)
+    if preview_scale != None:
+        t = ascii.read('data/' + projected_tbl)
+        t['file'] = [re.sub('^p', projected_prefix(), str(f)) for f in t['file']]
+        ascii.write(t, 'data/' + projected_tbl, format='ipac', overwrite=True)
     
-    # diff table
-    cmd = 'cd data && mOverlaps %s-raw.tbl %s-diffs.tbl' \
-          %(band_id, band_id)
-    if (verbose):
-        sys.stderr.write('\tRunning sub command: ' + cmd + '\n')
-    if subprocess.call(cmd, shell=True, stderr=redirect, stdout=redirect) != 0:
-        sys.stderr.write('\tCommand' + cmd + '  failed!\n')
-        sys.exit(1)
+    # background matching needs the overlaps, except for quick-look previews
+    match_backgrounds = preview_scale == None
+    if match_backgrounds:
+        # diff table
+        if overlap_finder == 'grid':
+            count = find_overlaps('data/%s-raw.tbl' %(band_id), 'data/%s-diffs.tbl' %(band_id),
+                                  with_area=overlap_area)
+            sys.stderr.write('\tFound %d overlapping image pairs\n' %(count))
+        else:
+            cmd = 'cd data && mOverlaps %s-raw.tbl %s-diffs.tbl' \
+                  %(band_id, band_id)
+            if (verbose):
+                sys.stderr.write('\tRunning sub command: ' + cmd + '\n')
+            if subprocess.call(cmd, shell=True, stderr=redirect, stdout=redirect) != 0:
+                sys.stderr.write('\tCommand' + cmd + '  failed!\n')
+                sys.exit(1)
+
+        # optionally drop redundant overlaps before generating the mDiffFit tasks
+        if prune_keep != None:
+            prune_overlaps('data/%s-raw.tbl' %(band_id), 'data/%s-diffs.tbl' %(band_id), prune_keep)
 
-    # statfile table
-    t = ascii.read('data/%s-diffs.tbl' %(band_id))
-    # make sure we have a wide enough column
-    t['stat'] = '                                                                  '
-    for row in t:
-        base_name = re.sub('(diff\.|\.fits.*)', '', row['diff'])
-        row['stat'] = '%s-fit.%s.txt' %(band_id, base_name)
-    ascii.write(t, 'data/%s-stat.tbl' %(band_id), format='ipac')
+        # statfile table
+        t = ascii.read('data/%s-diffs.tbl' %(band_id))
+        # a column as wide as the longest of the names
+        t['stat'] = ['%s-fit.%s.txt' %(band_id, fit_base_name(row)) for row in t]
+        ascii.write(t, 'data/%s-stat.tbl' %(band_id), format='ipac')
 
     # for all the input images in this band, and them to the rc, and
     # add reproject tasks
     data = ascii.read('data/%s-images.tbl' %(band_id))  
+    projectors = Table(names=('file', 'projector'), dtype=(str, str))
+    batch = []
     
     for row in data:
         
         base_name = re.sub('\.fits.*', '', row['file'])
 
+        in_fits = base_name + '.fits'
+        projected_fits = projected_prefix() + base_name + '.fits'
+        area_fits = projected_prefix() + base_name + '_area.fits'
+
+        # images projected by the previous run are neither downloaded nor projected
+        if not is_new(row['file']) and os.path.isfile('data/' + projected_fits) \
+           and os.path.isfile('data/' + area_fits):
+            continue
+
         # add an entry to the replica catalog
         wf.add_file_to_download('ipac', base_name + '.fits', row['URL'])
 
+        # in-process projection tasks, several images per task
+        if projection_engine == 'numpy':
+            batch.append((in_fits, projected_fits, area_fits))
+            if len(batch) == projection_batch:
+                add_projection_batch(wf, batch)
+                batch = []
+            continue
+
         # projection task
-        j = Task('mProject')
-        in_fits = base_name + '.fits'
-        projected_fits = 'p' + base_name + '.fits'
-        area_fits = 'p' + base_name + '_area.fits'
+        if fast_project:
+            projector = choose_projector(row, survey, in_fits)
+        else:
+            projector = 'mProject'
+        projectors.add_row((in_fits, projector))
+        j = Task(projector)
         j.add_inputs('region-oversized.hdr', in_fits)
-        j.add_outputs(projected_fits, area_fits, stage_out=False)
+        j.add_outputs(projected_fits, area_fits, stage_out=False, keep=kept_for_update())
         j.add_args('-X', in_fits, '-z', '0.1', projected_fits, 'region-oversized.hdr')
         
         wf.add_tasks(j)
 
-    fit_txts = []
-    data = ascii.read('data/%s-diffs.tbl' %(band_id))
-    for row in data:
-        
-        base_name = re.sub('(diff\.|\.fits.*)', '', row['diff'])
-
-        # mDiffFit task
-        j = Task('mDiffFit')
-        plus = 'p' + row['plus']
-        plus_area = re.sub('\.fits', '_area.fits', plus)
-        minus = 'p' + row['minus']
-        minus_area = re.sub('\.fits', '_area.fits', minus)
-        fit_txt = '%s-fit.%s.txt' %(band_id, base_name)
-        diff_fits = '%s-diff.%s.fits' %(band_id, base_name)
-        j.add_inputs(plus, plus_area, minus, minus_area, 'region-oversized.hdr')
-        j.add_outputs(fit_txt, stage_out=False)
-        j.add_args('-d', '-s', fit_txt, plus, minus, diff_fits, 'region-oversized.hdr')
-        wf.add_tasks(j)
-        fit_txts.append(fit_txt)
-
-    # mConcatFit
-    j = Task('mConcatFit')
-    stat_tbl = '%s-stat.tbl' %(band_id)
-    j.add_inputs(stat_tbl)
-    for fit_txt in fit_txts:
-        j.add_inputs(fit_txt)
-    fits_tbl = '%s-fits.tbl' %(band_id)
-    j.add_outputs(fits_tbl, stage_out=False)
-    j.add_args(stat_tbl, fits_tbl, '.')
-    wf.add_tasks(j)
+    if len(batch) > 0:
+        add_projection_batch(wf, batch)
 
-    # mBgModel
-    j = Task('mBgModel')
-    images_tbl = '%s-images.tbl' %(band_id)
-    corrections_tbl = '%s-corrections.tbl' %(band_id)
-    j.add_inputs(images_tbl, fits_tbl)
-    j.add_outputs(corrections_tbl, stage_out=False)
-    j.add_args('-i', '100000', images_tbl, fits_tbl, corrections_tbl)
-    wf.add_tasks(j)
+    # record which projection executable was used for each image
+    if fast_project:
+        ascii.write(projectors, 'data/%s-projectors.tbl' %(band_id), format='ipac', overwrite=True)
+        fast = list(projectors['projector']).count('mProjectPP')
+        sys.stderr.write('\tProjection plan: %d images with mProjectPP, %d with mProject\n'
+                         %(fast, len(projectors) - fast))
 
-    # mBackground
-    data = ascii.read('data/%s-raw.tbl' %(band_id))  
-    for row in data:
-        base_name = re.sub('(diff\.|\.fits.*)', '', row['file'])
+    if match_backgrounds:
+        fit_txts = []
+        data = ascii.read('data/%s-diffs.tbl' %(band_id))
+        for row in data:
+        
+            base_name = fit_base_name(row)
+
+            # mDiffFit task
+            j = Task('mDiffFit')
+            plus = 'p' + row['plus']
+            plus_area = re.sub('\.fits', '_area.fits', plus)
+            minus = 'p' + row['minus']
+            minus_area = re.sub('\.fits', '_area.fits', minus)
+            fit_txt = '%s-fit.%s.txt' %(band_id, base_name)
+
+            # fits between two images of the previous run are still valid
+            if not is_new(row['plus']) and not is_new(row['minus']) and os.path.isfile('data/' + fit_txt):
+                fit_txts.append(fit_txt)
+                continue
+            diff_fits = '%s-diff.%s.fits' %(band_id, base_name)
+            j.add_inputs(plus, plus_area, minus, minus_area, 'region-oversized.hdr')
+            j.add_outputs(fit_txt, stage_out=False, keep=kept_for_update())
+            j.add_args('-d', '-s', fit_txt, plus, minus, diff_fits, 'region-oversized.hdr')
+            wf.add_tasks(j)
+            fit_txts.append(fit_txt)
+
+        # mConcatFit
+        j = Task('mConcatFit')
+        stat_tbl = '%s-stat.tbl' %(band_id)
+        j.add_inputs(stat_tbl)
+        for fit_txt in fit_txts:
+            j.add_inputs(fit_txt)
+        fits_tbl = '%s-fits.tbl' %(band_id)
+        j.add_outputs(fits_tbl, stage_out=False)
+        j.add_args(stat_tbl, fits_tbl, '.')
+        wf.add_tasks(j)
 
-        # mBackground task
-        j = Task('mBackground')
-        projected_fits = 'p' + base_name + '.fits'
-        projected_area = 'p' + base_name + '_area.fits'
-        corrected_fits = 'c' + base_name + '.fits'
-        corrected_area = 'c' + base_name + '_area.fits'
-        j.add_inputs(projected_fits, projected_area, projected_tbl, corrections_tbl)
-        j.add_outputs(corrected_fits, corrected_area, stage_out=False)
-        j.add_args('-t', projected_fits, corrected_fits, projected_tbl, corrections_tbl)
+        # mBgModel - in update mode, the previous corrections are kept and
+        # only the new images are solved for, starting from their neighbors
+        images_tbl = '%s-images.tbl' %(band_id)
+        corrections_tbl = '%s-corrections.tbl' %(band_id)
+        if previous != None:
+            # this run saves its own state under the same name, so use a copy
+            previous_tbl = '%s-previous-state.tbl' %(band_id)
+            shutil.copyfile('data/' + previous_state_file(band_id), 'data/' + previous_tbl)
+            j = Task('mBgModelPy')
+            j.add_inputs(images_tbl, fits_tbl, previous_tbl)
+            j.add_outputs(corrections_tbl, stage_out=False)
+            j.add_args('-i', '100000', images_tbl, fits_tbl, corrections_tbl, '-w', previous_tbl)
+        else:
+            j = Task('mBgModel')
+            j.add_inputs(images_tbl, fits_tbl)
+            j.add_outputs(corrections_tbl, stage_out=False)
+            j.add_args('-i', '100000', images_tbl, fits_tbl, corrections_tbl)
         wf.add_tasks(j)
 
+        # mBackground
+        data = ascii.read('data/%s-raw.tbl' %(band_id))  
+        for row in data:
+            base_name = re.sub('(diff\.|\.fits.*)', '', row['file'])
+
+            # mBackground task
+            j = Task(background_engine)
+            projected_fits = 'p' + base_name + '.fits'
+            projected_area = 'p' + base_name + '_area.fits'
+            corrected_fits = 'c' + base_name + '.fits'
+            corrected_area = 'c' + base_name + '_area.fits'
+            if not is_new(row['file']) and os.path.isfile('data/' + corrected_fits) \
+               and os.path.isfile('data/' + corrected_area):
+                continue
+            j.add_inputs(projected_fits, projected_area, projected_tbl, corrections_tbl)
+            j.add_outputs(corrected_fits, corrected_area, stage_out=False, keep=kept_for_update())
+            j.add_args('-t', projected_fits, corrected_fits, projected_tbl, corrections_tbl)
+            wf.add_tasks(j)
+
+    # previews co-add the projected images directly
+    if match_backgrounds:
+        coadd_tbl = corrected_tbl
+    else:
+        coadd_tbl = projected_tbl
+
     # mImgtbl - we need an updated corrected images table because the pixel offsets and sizes need
     # to be exactly right and the original is only an approximation
     j = Task('mImgtbl')
     updated_corrected_tbl = '%s-updated-corrected.tbl' %(band_id)
-    j.add_inputs(corrected_tbl)
+    j.add_inputs(coadd_tbl)
     j.add_outputs(updated_corrected_tbl, stage_out=False)
-    j.add_args('.', '-t', corrected_tbl, updated_corrected_tbl)
-    data = ascii.read('data/%s-corrected.tbl' %(band_id))  
+    j.add_args('.', '-t', coadd_tbl, updated_corrected_tbl)
+    data = ascii.read('data/%s' %(coadd_tbl))  
     for row in data:
         base_name = re.sub('(diff\.|\.fits.*)', '', row['file'])
         projected_fits = base_name + '.fits'
@@ -450,48 +2515,208 @@ def add_band(wf, band_id, center, degrees, survey, band, color):
     wf.add_tasks(j)
 
     # mAdd
-    j = Task('mAdd')
-    mosaic_fits = '%s-mosaic.fits' %(band_id)
-    mosaic_area = '%s-mosaic_area.fits' %(band_id)
-    j.add_inputs(updated_corrected_tbl, 'region.hdr')
-    j.add_outputs(mosaic_fits, mosaic_area, stage_out=True)
-    j.add_args('-e', updated_corrected_tbl, 'region.hdr', mosaic_fits)
-    data = ascii.read('data/%s-corrected.tbl' %(band_id))  
+    mosaic_fits = '%s.fits' %(mosaic_name(band_id))
+    mosaic_area = '%s_area.fits' %(mosaic_name(band_id))
+    coadd_files = []
+    data = ascii.read('data/%s' %(coadd_tbl))  
     for row in data:
         base_name = re.sub('(diff\.|\.fits.*)', '', row['file'])
-        corrected_fits = base_name + '.fits'
-        corrected_area = base_name + '_area.fits'
-        j.add_inputs(corrected_fits, corrected_area)
-    wf.add_tasks(j)
+        coadd_files.append(base_name + '.fits')
+        coadd_files.append(base_name + '_area.fits')
+    if progressive_tiles != None:
+        if previous != None:
+            new_rows = [row for row in ascii.read('data/%s-images.tbl' %(band_id)) if is_new(row['file'])]
+        else:
+            new_rows = None
+        add_progressive_coadd(wf, band_id, updated_corrected_tbl, coadd_files, mosaic_fits, mosaic_area,
+                              new_rows)
+    else:
+        j = Task('mAdd')
+        j.add_inputs(updated_corrected_tbl, 'region.hdr')
+        # with compression, the compressed mosaics are the final products
+        j.add_outputs(mosaic_fits, mosaic_area, stage_out=(mosaic_compression == None))
+        j.add_args('-e', updated_corrected_tbl, 'region.hdr', mosaic_fits)
+        j.add_inputs(*coadd_files)
+        wf.add_tasks(j)
+
+    # mSaveStatePy - remember the images and corrections for the next update
+    if update_mode and match_backgrounds:
+        j = Task('mSaveStatePy')
+        j.add_inputs(images_tbl, corrections_tbl)
+        j.add_outputs(previous_state_file(band_id), stage_out=False)
+        j.add_args(images_tbl, corrections_tbl, previous_state_file(band_id))
+        wf.add_tasks(j)
 
     # mViewer - Make the JPEG for this channel
-    j = Task('mViewer')
-    mosaic_png = '%s-mosaic.png' %(band_id)
+    j = Task(renderer)
+    mosaic_png = '%s.png' %(mosaic_name(band_id))
     j.add_inputs(mosaic_fits)
     j.add_outputs(mosaic_png, stage_out=True)
+    # the in-process renderer keeps the statistics for the color composite
+    if renderer == 'mViewerPy':
+        j.add_outputs(statistics_file(mosaic_fits), stage_out=False)
     j.add_args('-ct', '1', '-gray', mosaic_fits, '-1s', 'max', 'gaussian', \
                '-png', mosaic_png)
     wf.add_tasks(j)
 
+    # mTilePyramidPy - cut the mosaic into a multi-resolution tile pyramid
+    if tile_pyramid != None:
+        j = Task('mTilePyramidPy')
+        tiles_dir = '%s-tiles' %(band_id)
+        j.add_inputs(mosaic_fits)
+        j.add_outputs(tiles_dir, stage_out=True)
+        j.add_args(mosaic_fits, tiles_dir, tile_pyramid, str(tile_size))
+        wf.add_tasks(j)
+
+    # mCompressPy - tile-compress the mosaic and its area, one task each
+    if mosaic_compression != None:
+        for f in (mosaic_fits, mosaic_area):
+            j = Task('mCompressPy')
+            j.add_inputs(f)
+            j.add_outputs(f + '.fz', stage_out=True)
+            j.add_args(f, f + '.fz', mosaic_compression)
+            wf.add_tasks(j)
+
+    for task in wf.tasks[first_task:]:
+        task.band = band_id
+
+def add_progressive_coadd(wf, band_id, images_tbl, coadd_files, mosaic_fits, mosaic_area, new_rows=None):
+
+    tiles = region_tiles(progressive_tiles)
+    # tiles are named after the mosaic, so previews have their own
+    name = mosaic_name(band_id)
+
+    # in update mode, only the tiles touched by new images are co-added again
+    touched = set()
+    for (tile_hdr, x0, y0) in tiles:
+        tile_fits = '%s-%s' %(name, re.sub('\.hdr$', '.fits', tile_hdr))
+        if new_rows == None or not os.path.isfile('data/' + tile_fits) or \
+           tile_touched('data/' + tile_hdr, new_rows):
+            touched.add(tile_hdr)
+
+    # mTileTblPy - one image table per tile, with the images overlapping it
+    j = Task('mTileTblPy')
+    j.add_inputs(images_tbl)
+    j.add_args(images_tbl)
+    for (tile_hdr, x0, y0) in tiles:
+        if tile_hdr not in touched:
+            continue
+        tile_tbl = '%s-%s' %(name, re.sub('\.hdr$', '.tbl', tile_hdr))
+        j.add_inputs(tile_hdr)
+        j.add_outputs(tile_tbl, stage_out=False)
+        j.add_args(tile_hdr, tile_tbl)
+    wf.add_tasks(j)
+
+    # mAdd per tile, then paste the tiles into the mosaic, center first
+    marker = None
+    for (rank, (tile_hdr, x0, y0)) in enumerate(tiles):
+        tile_tbl = '%s-%s' %(name, re.sub('\.hdr$', '.tbl', tile_hdr))
+        tile_fits = '%s-%s' %(name, re.sub('\.hdr$', '.fits', tile_hdr))
+        tile_area = re.sub('\.fits$', '_area.fits', tile_fits)
+
+        if tile_hdr in touched:
+            j = Task('mAddTilePy')
+            j.add_inputs(tile_tbl, tile_hdr)
+            j.add_inputs(*coadd_files)
+            j.add_outputs(tile_fits, tile_area, stage_out=False, keep=kept_for_update())
+            j.add_args('-e', tile_tbl, tile_hdr, tile_fits)
+            j.priority = len(tiles) - rank
+            wf.add_tasks(j)
+
+        j = Task('mPasteTilePy')
+        j.add_inputs(tile_fits, tile_area, 'region.hdr')
+        if marker != None:
+            j.add_inputs(marker)
+        if rank == len(tiles) - 1:
+            j.add_outputs(mosaic_fits, mosaic_area, stage_out=(mosaic_compression == None))
+            marker = '-'
+        else:
+            marker = '%s-progress.%d' %(name, rank)
+            j.add_outputs(marker, stage_out=False)
+        j.add_args(tile_fits, mosaic_fits, str(x0), str(y0), marker, 'new' if rank == 0 else 'update')
+        j.priority = len(tiles) - rank
+        # every paste is a level of its own: waiting for the level barrier
+        # would hold it until all the tiles are co-added
+        j.wait_for_level = False
+        wf.add_tasks(j)
+
+def fit_base_name(row):
+
+    # in update mode the fits are named after the images, so that they
+    # can be reused when new images change the image ids
+    if update_mode:
+        return '%s.%s' %(re.sub('\.fits.*', '', row['plus']), re.sub('\.fits.*', '', row['minus']))
+    return re.sub('(diff\.|\.fits.*)', '', row['diff'])
+
+def kept_for_update():
+
+    # the projected, fitted, corrected and tile images are reused by the
+    # next --update run (previews start from scratch), so they are not
+    # intermediates to delete
+    return update_mode and preview_scale == None
+
+def previous_state_file(band_id):
+
+    # not a .tbl, so that it survives the clean up of data/
+    return '%s-state.tbl.prev' %(band_id)
+
+def load_previous_state(band_id):
+
+    path = 'data/' + previous_state_file(band_id)
+    if not os.path.isfile(path):
+        return None
+    return set(ascii.read(path, format='ipac')['file'])
+
+def mosaic_name(band_id):
+
+    # quick-look previews don't overwrite the full resolution mosaics
+    if preview_scale != None:
+        return '%s-preview' %(band_id)
+    return '%s-mosaic' %(band_id)
+
+def projected_prefix():
+
+    # nor their projected images, which a full resolution update would reuse
+    if preview_scale != None:
+        return 'preview-p'
+    return 'p'
+
+def add_projection_batch(wf, batch):
+
+    j = Task('mProjectPy')
+    j.add_inputs('region-oversized.hdr')
+    j.add_args('region-oversized.hdr')
+    for (in_fits, projected_fits, area_fits) in batch:
+        j.add_inputs(in_fits)
+        j.add_outputs(projected_fits, area_fits, stage_out=False, keep=kept_for_update())
+        j.add_args(in_fits, projected_fits)
+    wf.add_tasks(j)
+
 def color_png(wf, red_id, green_id, blue_id):
+    global renderer
+    global preview_scale
 
     red_id = str(red_id)
     green_id = str(green_id)
     blue_id = str(blue_id)
 
     # mJPEG - Make the JPEG for this channel
-    j = Task('mViewer')
-    mosaic_png = 'mosaic-color.png'
-    red_fits = '%s-mosaic.fits' %(red_id)
-    green_fits = '%s-mosaic.fits' %(green_id)
-    blue_fits = '%s-mosaic.fits' %(blue_id)
+    j = Task(renderer)
+    mosaic_png = 'mosaic-color.png' if preview_scale == None else 'preview-color.png'
+    red_fits = '%s.fits' %(mosaic_name(red_id))
+    green_fits = '%s.fits' %(mosaic_name(green_id))
+    blue_fits = '%s.fits' %(mosaic_name(blue_id))
     j.add_inputs(red_fits, green_fits, blue_fits)
+    if renderer == 'mViewerPy':
+        for f in (red_fits, green_fits, blue_fits):
+            j.add_inputs(statistics_file(f))
     j.add_outputs(mosaic_png, stage_out=True)
     j.add_args( \
             '-red', red_fits, '-0.5s', 'max', 'gaussian-log', \
             '-green', green_fits, '-0.5s', 'max', 'gaussian-log', \
             '-blue', blue_fits, '-0.5s', 'max', 'gaussian-log', \
             '-png', mosaic_png)
+    j.band = 'color'
     wf.add_tasks(j)
 
 
@@ -516,9 +2741,121 @@ if __name__ == '__main__':
                         help = 'Number of degrees of side of the output')
     parser.add_argument('--band', action = 'append', dest = 'bands',
                         help = 'Band definition. Example: dss:DSS2B:red')
+    parser.add_argument('--overlaps', action = 'store', dest = 'overlaps', default = 'mOverlaps',
+                        choices = ['mOverlaps', 'grid'],
+                        help = 'How to find overlapping images: mOverlaps or the built-in grid index')
+    parser.add_argument('--overlap-area', action = 'store_true', dest = 'overlap_area',
+                        help = 'Add the overlap area to the diffs table (grid overlap finder only)')
+    parser.add_argument('--prune-overlaps', action = 'store', dest = 'prune_overlaps', type = int,
+                        help = 'Only keep a spanning set plus the N largest overlaps of each image')
+    parser.add_argument('--cull', action = 'store_true', dest = 'cull',
+                        help = 'Drop archive images more than one overlap away from the output region')
+    parser.add_argument('--coverage-depth', action = 'store', dest = 'coverage_depth', type = int,
+                        help = 'Only keep enough images to cover the region this many times')
+    parser.add_argument('--coverage-weight', action = 'store', dest = 'coverage_weight',
+                        help = 'Image table column used to prefer images when selecting for coverage')
+    parser.add_argument('--fast-project', action = 'store_true', dest = 'fast_project',
+                        help = 'Use mProjectPP instead of mProject for TAN input images')
+    parser.add_argument('--projection-engine', action = 'store', dest = 'projection_engine', default = 'mProject',
+                        choices = ['mProject', 'numpy'],
+                        help = 'Reproject with Montage or with the in-process NumPy engine')
+    parser.add_argument('--projection-batch', action = 'store', dest = 'projection_batch', type = int, default = 1,
+                        help = 'Number of images reprojected per in-process projection task')
+    parser.add_argument('--background-engine', action = 'store', dest = 'background_engine', default = 'mBackground',
+                        choices = ['mBackground', 'numpy'],
+                        help = 'Apply background corrections with Montage or in-process')
+    parser.add_argument('--data-plane', action = 'store', dest = 'data_plane', default = 'disk',
+                        choices = ['disk', 'memory'],
+                        help = 'Hand images between in-process tasks through data/ or, when no command reads them, '
+                               'in worker memory. No image of the standard workflow qualifies, as each is read '
+                               'by a command such as mDiffFit, mImgtbl or mAdd')
+    parser.add_argument('--scratch-dir', action = 'store', dest = 'scratch_dir',
+                        help = 'Fast directory (e.g. under /dev/shm) for intermediate files')
+    parser.add_argument('--scratch-limit', action = 'store', dest = 'scratch_limit', type = float, default = 0,
+                        help = 'Capacity of the scratch directory in GB, intermediates go to data/ beyond it')
+    parser.add_argument('--gc-intermediates', action = 'store_true', dest = 'gc_intermediates',
+                        help = 'Delete intermediate files as soon as their last consumer is done, except the ones reused by --update')
+    parser.add_argument('--output-dir', action = 'store', dest = 'output_dir',
+                        help = 'Directory to stage out the final products to, while the workflow runs')
+    parser.add_argument('--stage-out-mode', action = 'store', dest = 'stage_out_mode', default = 'copy',
+                        choices = ['copy', 'move'],
+                        help = 'Copy the final products to the output directory, or move them')
+    parser.add_argument('--stage-out-threads', action = 'store', dest = 'stage_out_threads', type = int, default = 4,
+                        help = 'Number of parallel stage-out copies')
+    parser.add_argument('--pixel-type', action = 'store', dest = 'pixel_type', default = 'float64',
+                        choices = ['float32', 'float64'],
+                        help = 'Pixel type of the output templates and of the in-process stages')
+    parser.add_argument('--compress-mosaic', action = 'store', dest = 'compress_mosaic',
+                        choices = ['rice', 'gzip', 'lossless'],
+                        help = 'Also write the mosaics as tile-compressed FITS, staged out instead of the originals')
+    parser.add_argument('--tile-pyramid', action = 'store', dest = 'tile_pyramid',
+                        choices = ['png', 'fits'],
+                        help = 'Also cut each mosaic into a z/x/y pyramid of PNG or FITS tiles')
+    parser.add_argument('--tile-size', action = 'store', dest = 'tile_size', type = int, default = 256,
+                        help = 'Size of the pyramid tiles, in pixels')
+    parser.add_argument('--pyramid-threads', action = 'store', dest = 'pyramid_threads', type = int, default = 4,
+                        help = 'Number of threads writing pyramid tiles')
+    parser.add_argument('--renderer', action = 'store', dest = 'renderer', default = 'mViewer',
+                        choices = ['mViewer', 'numpy'],
+                        help = 'Render the PNGs with mViewer or with the in-process renderer')
+    parser.add_argument('--render-threads', action = 'store', dest = 'render_threads', type = int, default = 4,
+                        help = 'Number of threads rendering a PNG in-process')
+    parser.add_argument('--preview-scale', action = 'store', dest = 'preview_scale', type = float,
+                        help = 'Make a quick-look preview with pixels this many times coarser, without background matching')
+    parser.add_argument('--then-full', action = 'store_true', dest = 'then_full',
+                        help = 'After the preview, run the full resolution workflow reusing the downloads')
+    parser.add_argument('--progressive-tiles', action = 'store', dest = 'progressive_tiles', type = int,
+                        help = 'Co-add the mosaic as N x N tiles, center first, refreshing it after each tile')
+    parser.add_argument('--update', action = 'store_true', dest = 'update',
+                        help = 'Only process the archive images that are new since the previous --update run')
+    parser.add_argument('--archive', action = 'store', dest = 'archive',
+                        help = 'URL of a local archive serving images.tbl and the images, used instead of mArchiveList')
+    parser.add_argument('--workers', action = 'store', dest = 'workers', type = int,
+                        help = 'Number of Dask workers (default: chosen by Dask from the cores)')
+    parser.add_argument('--threads-per-worker', action = 'store', dest = 'threads_per_worker', type = int,
+                        help = 'Number of threads per Dask worker')
+    parser.add_argument('--save-plan', action = 'store', dest = 'save_plan',
+                        help = 'Save the planned workflow as JSON, for the scheduling simulator')
+    parser.add_argument('--runtime-db', action = 'store', dest = 'runtime_db',
+                        help = 'SQLite database recording the task runtimes, whose cost model sets the task priorities')
+    parser.add_argument('--plan-only', action = 'store_true', dest = 'plan_only',
+                        help = 'Only estimate the makespan from the --runtime-db cost model, without running')
+    parser.add_argument('--trace', action = 'store', dest = 'trace',
+                        help = 'Write a per-task trace to TRACE.jsonl and a Chrome/Perfetto trace to TRACE.json')
     args = parser.parse_args()
     
     verbose = args.verbose
+    overlap_finder = args.overlaps
+    overlap_area = args.overlap_area
+    prune_keep = args.prune_overlaps
+    cull_images = args.cull
+    coverage_depth = args.coverage_depth
+    coverage_weight = args.coverage_weight
+    fast_project = args.fast_project
+    projection_engine = args.projection_engine
+    projection_batch = args.projection_batch
+    background_engine = 'mBackgroundPy' if args.background_engine == 'numpy' else 'mBackground'
+    data_plane = args.data_plane
+    gc_intermediates = args.gc_intermediates
+    pixel_type = args.pixel_type
+    mosaic_compression = args.compress_mosaic
+    tile_pyramid = args.tile_pyramid
+    tile_size = args.tile_size
+    pyramid_threads = args.pyramid_threads
+    renderer = 'mViewerPy' if args.renderer == 'numpy' else 'mViewer'
+    render_threads = args.render_threads
+    preview_scale = args.preview_scale
+    progressive_tiles = args.progressive_tiles
+    update_mode = args.update
+    trace_prefix = args.trace
+    archive_url = args.archive
+    if args.runtime_db:
+        runtime_db = os.path.abspath(args.runtime_db)
+    stage_out_mode = args.stage_out_mode
+    stage_out_threads = args.stage_out_threads
+    if args.output_dir:
+        output_dir = os.path.abspath(args.output_dir)
+    scratch_limit = int(args.scratch_limit * 1024 ** 3)
 
     if args.center == None:
         sys.stderr.write("--center argument required\n")
@@ -544,15 +2881,58 @@ if __name__ == '__main__':
     # Clean up data directory of the .tbl and .hdr files, if any
     os.system("rm -f ./data/*.tbl ./data/*.hdr")
 
-    # creating DASK client
-    client = Client()
+    # Create the scratch directory for intermediate files, if any
+    if args.scratch_dir:
+        scratch_dir = os.path.abspath(args.scratch_dir)
+        if not os.path.isdir(scratch_dir):
+            os.makedirs(scratch_dir)
+
+    # creating DASK client, on a local cluster of the requested size
+    client = Client(n_workers=args.workers, threads_per_worker=args.threads_per_worker)
 
     # Generate the workflow object
     wf = generate_workflow(args.center, args.degrees, args.bands)
 
+    # Only estimate the makespan from the runtime database
+    if args.plan_only:
+        if runtime_db == None or not os.path.isfile(runtime_db):
+            sys.stderr.write("--plan-only requires an existing --runtime-db\n")
+            sys.exit(1)
+        costs = task_costs(wf, load_cost_model(runtime_db))
+        # as many slots as the cluster has threads, with Dask's defaults
+        slots = sum(client.nthreads().values())
+        unknown = sorted(set(task.executable for (task, cost) in zip(wf.tasks, costs) if cost[0] == None))
+        sys.stderr.write("Planned " + str(len(wf.tasks)) + " tasks, " +
+                         "{:.2f}".format(sum(cost[0] or 0.0 for cost in costs)) + " seconds of work\n")
+        sys.stderr.write("Estimated makespan on " + str(slots) + " slots: " +
+                         "{:.2f}".format(estimate_makespan(wf, costs, slots)) + " seconds\n")
+        memory = [cost[1] for cost in costs if cost[1] != None]
+        if len(memory) > 0:
+            sys.stderr.write("Largest command memory: " +
+                             "{:.1f}".format(max(memory) / 1024 ** 2) + " MiB (in-process tasks excluded)\n")
+        if len(unknown) > 0:
+            sys.stderr.write("No runtime history for " + ', '.join(unknown) + ", counted as free\n")
+        sys.exit(0)
+
     # Download all input FITS files, if not already present
     wf.download_all_input_files()
 
+    # Run the tasks leading the longest predicted chains first
+    if runtime_db != None and os.path.isfile(runtime_db):
+        set_cost_priorities(wf, task_costs(wf, load_cost_model(runtime_db)))
+
+    # Keep the planned workflow for the scheduling simulator
+    if args.save_plan:
+        wf.save_plan(args.save_plan)
+
     # Run the workflow sequentially
     wf.run()
 
+    # The full resolution workflow reuses the preview's downloads
+    if preview_scale != None and args.then_full:
+        os.system("rm -f ./data/*.tbl ./data/*.hdr")
+        preview_scale = None
+        wf = generate_workflow(args.center, args.degrees, args.bands)
+        wf.download_all_input_files()
+        wf.run()
+
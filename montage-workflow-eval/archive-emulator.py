@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import io
+import math
+import shutil
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from astropy.io import ascii
+
+
+'''
+Function to tell whether an image of the table touches the box of the
+given size around (ra0, dec0), comparing the offsets of its corners on
+the tangent plane with the half-size of the box
+'''
+def touches_box(row, ra0, dec0, size):
+    half = size / 2.0
+    xs = []
+    ys = []
+    for i in range(1, 5):
+        ra = math.radians(float(row['ra%d' %(i)]))
+        dec = math.radians(float(row['dec%d' %(i)]))
+        (a0, d0) = (math.radians(ra0), math.radians(dec0))
+        cos_c = math.sin(d0) * math.sin(dec) + math.cos(d0) * math.cos(dec) * math.cos(ra - a0)
+        if cos_c <= 0:
+            return False
+        xs.append(math.degrees(math.cos(dec) * math.sin(ra - a0) / cos_c))
+        ys.append(math.degrees((math.cos(d0) * math.sin(dec) -
+                                math.sin(d0) * math.cos(dec) * math.cos(ra - a0)) / cos_c))
+    return min(xs) < half and max(xs) > -half and min(ys) < half and max(ys) > -half
+
+
+'''
+Handler answering image table queries like mArchiveList would, and
+serving the plates themselves
+'''
+class ArchiveHandler(BaseHTTPRequestHandler):
+    sky_dir = '.'
+    table = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/images.tbl':
+            self.send_table(parse_qs(url.query))
+        elif url.path.startswith('/plates/'):
+            self.send_plate(os.path.basename(url.path))
+        else:
+            self.send_error(404)
+
+    def send_table(self, query):
+        try:
+            (ra0, dec0) = [float(v) for v in query['center'][0].split()]
+            size = float(query['size'][0])
+        except (KeyError, ValueError):
+            self.send_error(400, 'expected center="RA Dec" and size in degrees')
+            return
+        table = self.table[[touches_box(row, ra0, dec0, size) for row in self.table]]
+        root = 'http://%s/' %(self.headers.get('Host', '%s:%d' %self.server.server_address))
+        table['URL'] = [root + url for url in table['URL']]
+        text = io.StringIO()
+        ascii.write(table, text, format='ipac')
+        body = text.getvalue().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_plate(self, name):
+        path = os.path.join(self.sky_dir, 'plates', name)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/fits')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+'''
+Main
+'''
+
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--sky-dir', action = 'store', dest = 'sky_dir', default = 'synthetic-sky',
+                        help = 'Directory written by synthetic-sky.py')
+    parser.add_argument('--host', action = 'store', dest = 'host', default = '127.0.0.1',
+                        help = 'Address to listen on')
+    parser.add_argument('--port', action = 'store', dest = 'port', type = int, default = 8632,
+                        help = 'Port to listen on')
+    parser.add_argument('--verbose', action = 'store_true', dest = 'verbose',
+                        help = 'Log every request')
+    args = parser.parse_args()
+
+    ArchiveHandler.sky_dir = args.sky_dir
+    ArchiveHandler.table = ascii.read(os.path.join(args.sky_dir, 'images.tbl'), format='ipac')
+    ArchiveHandler.verbose = args.verbose
+    server = ThreadingHTTPServer((args.host, args.port), ArchiveHandler)
+    sys.stderr.write("Serving " + str(len(ArchiveHandler.table)) + " plates from " + args.sky_dir +
+                     " on http://%s:%d/\n" %(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
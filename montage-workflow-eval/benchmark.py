@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import datetime
+import importlib.metadata
+import json
+import platform
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+eval_dir = os.path.dirname(os.path.abspath(__file__))
+
+# The configurations of eval_both.sh: the sequential workflow and the
+# Dask workflow, the latter reporting its per-task trace
+default_configs = {
+    'sequential': 'python3 %s {args}' %(os.path.join(eval_dir, 'montage-workflow-seq.py')),
+    'dask': 'python3 %s {args} --trace {trace}' %(os.path.join(eval_dir, '..', 'montage-workflow-dask',
+                                                                  'montage-workflow-dask.py')),
+}
+default_args = '--center "56.7 24.0" --degrees 1.0 --band dss:DSS2B:red'
+
+total_re = re.compile(r'Workflow execution done in ([0-9.]+) seconds')
+running_re = re.compile(r'Running a (\S+) task')
+executed_re = re.compile(r'\[executed in ([0-9.]+) seconds\]')
+
+
+'''
+Function to describe the machine and software a benchmark ran on
+'''
+def environment():
+    cpu = platform.processor()
+    memory = None
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    cpu = line.split(':', 1)[1].strip()
+                    break
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal'):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+
+    versions = {'python': platform.python_version()}
+    for package in ('numpy', 'astropy', 'dask', 'distributed'):
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package] = None
+    montage = shutil.which('mProject')
+    versions['montage'] = os.path.dirname(os.path.dirname(montage)) if montage else None
+
+    try:
+        commit = subprocess.check_output(['git', '-C', eval_dir, 'rev-parse', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'cpu': cpu,
+        'cores': os.cpu_count(),
+        'memory': memory,
+        'versions': versions,
+        'commit': commit,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+'''
+Function to extract the per-stage times from the output of a workflow
+run: the time of every "Running a X task" line is the one of the next
+"[executed in Y seconds]" line, which holds for sequential runs
+'''
+def stages_from_log(log):
+    stages = {}
+    pending = []
+    for line in log.splitlines():
+        match = running_re.search(line)
+        if match:
+            pending.append(match.group(1))
+            continue
+        match = executed_re.search(line)
+        if match and len(pending) > 0:
+            executable = pending.pop(0)
+            stages[executable] = stages.get(executable, 0.0) + float(match.group(1))
+    return stages
+
+
+'''
+Function to extract the per-stage times from a task trace written
+with --trace, exact even when the tasks ran concurrently
+'''
+def stages_from_trace(trace_file):
+    stages = {}
+    with open(trace_file) as f:
+        for line in f:
+            record = json.loads(line)
+            stages[record['executable']] = stages.get(record['executable'], 0.0) + \
+                record['end'] - record['start']
+    return stages
+
+
+'''
+Function to run one trial of a configuration, returning its total and
+per-stage times
+'''
+def run_trial(command, workflow_args, work_dir, trial_name):
+    trace = os.path.join(work_dir, trial_name)
+    cmd = command.replace('{args}', workflow_args).replace('{trace}', trace)
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, shell=True, cwd=work_dir, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True, errors='replace')
+    elapsed = time.perf_counter() - start
+    shutil.rmtree(os.path.join(work_dir, 'dask-worker-space'), ignore_errors=True)
+
+    match = total_re.search(proc.stderr)
+    if os.path.isfile(trace + '.jsonl'):
+        stages = stages_from_trace(trace + '.jsonl')
+    else:
+        stages = stages_from_log(proc.stderr)
+    return {
+        'exit_code': proc.returncode,
+        'total': float(match.group(1)) if match else None,
+        'elapsed': elapsed,
+        'stages': stages,
+    }
+
+
+'''
+Function to compute the statistics of a sample: median, interquartile
+range and a bootstrap confidence interval of the median
+'''
+def describe(values, confidence=0.95, resamples=2000, seed=632):
+    values = np.asarray([v for v in values if v is not None], dtype=float)
+    if len(values) == 0:
+        return None
+    rng = np.random.default_rng(seed)
+    medians = np.median(rng.choice(values, (resamples, len(values))), axis=1)
+    alpha = (1.0 - confidence) / 2.0
+    (q1, q3) = np.percentile(values, [25, 75])
+    return {
+        'n': int(len(values)),
+        'median': float(np.median(values)),
+        'mean': float(np.mean(values)),
+        'stdev': float(np.std(values, ddof=1)) if len(values) > 1 else 0.0,
+        'iqr': float(q3 - q1),
+        'min': float(np.min(values)),
+        'max': float(np.max(values)),
+        'ci': [float(np.quantile(medians, alpha)), float(np.quantile(medians, 1.0 - alpha))],
+    }
+
+
+'''
+Function to summarize the trials of a configuration
+'''
+def summarize(trials):
+    stages = sorted(set(stage for trial in trials for stage in trial['stages']))
+    return {
+        'total': describe([trial['total'] for trial in trials]),
+        'elapsed': describe([trial['elapsed'] for trial in trials]),
+        'stages': {stage: describe([trial['stages'].get(stage, 0.0) for trial in trials])
+                   for stage in stages},
+    }
+
+
+'''
+Function to compare results against a baseline. A metric regresses when
+its median grew by more than the threshold and the lower end of its
+confidence interval is above the baseline median too, so that noise
+within the spread of the runs is not flagged
+'''
+def compare(results, baseline, threshold):
+    rows = []
+    for (name, config) in results['configs'].items():
+        if name not in baseline['configs']:
+            continue
+        base = baseline['configs'][name]['summary']
+        current = config['summary']
+        metrics = [('total', current['total'], base['total'])]
+        for stage in current['stages']:
+            if stage in base['stages']:
+                metrics.append((stage, current['stages'][stage], base['stages'][stage]))
+        for (metric, now, then) in metrics:
+            if now == None or then == None or then['median'] <= 0:
+                continue
+            change = now['median'] / then['median'] - 1.0
+            regressed = change > threshold and now['ci'][0] > then['median']
+            improved = change < -threshold and now['ci'][1] < then['median']
+            rows.append((name, metric, then['median'], now['median'], change,
+                         'REGRESSION' if regressed else ('improved' if improved else '')))
+    return rows
+
+
+'''
+Function to print the summary of every configuration
+'''
+def report(results, output):
+    for (name, config) in results['configs'].items():
+        summary = config['summary']
+        output.write('%s (%d trials, %d failed)\n' %(name, len(config['trials']),
+                     sum(1 for trial in config['trials'] if trial['exit_code'] != 0)))
+        output.write('  %-16s %10s %10s   %-21s\n' %('', 'median (s)', 'iqr (s)', 'ci (s)'))
+        rows = [('total', summary['total'])] + sorted(summary['stages'].items(),
+                                                      key=lambda item: -item[1]['median'])
+        for (metric, stats) in rows:
+            if stats == None:
+                continue
+            output.write('  %-16s %10.2f %10.2f %10.2f-%-10.2f\n' %(metric, stats['median'],
+                         stats['iqr'], stats['ci'][0], stats['ci'][1]))
+
+
+'''
+Main
+'''
+
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--config', action = 'append', dest = 'configs', default = [],
+                        help = 'Configuration to run, either one of ' + ', '.join(default_configs) +
+                        ' or NAME=COMMAND, where {args} and {trace} are substituted in COMMAND')
+    parser.add_argument('--args', action = 'store', dest = 'workflow_args', default = default_args,
+                        help = 'Workflow arguments substituted for {args}')
+    parser.add_argument('--warmups', action = 'store', dest = 'warmups', type = int, default = 1,
+                        help = 'Number of discarded runs before the trials')
+    parser.add_argument('--trials', action = 'store', dest = 'trials', type = int, default = 5,
+                        help = 'Number of measured runs')
+    parser.add_argument('--work-dir', action = 'store', dest = 'work_dir', default = '.',
+                        help = 'Directory to run the workflows in')
+    parser.add_argument('--output', action = 'store', dest = 'output', default = 'benchmark.json',
+                        help = 'JSON file to write the results to')
+    parser.add_argument('--baseline', action = 'store', dest = 'baseline',
+                        help = 'Results of an earlier run to compare against')
+    parser.add_argument('--threshold', action = 'store', dest = 'threshold', type = float, default = 0.05,
+                        help = 'Relative slowdown of a median flagged as a regression')
+    args = parser.parse_args()
+
+    configs = {}
+    for config in args.configs or list(default_configs):
+        if '=' in config:
+            (name, command) = config.split('=', 1)
+        elif config in default_configs:
+            (name, command) = (config, default_configs[config])
+        else:
+            sys.stderr.write("Unknown configuration " + config + "\n")
+            sys.exit(1)
+        configs[name] = command
+
+    work_dir = os.path.abspath(args.work_dir)
+    results = {'environment': environment(), 'workflow args': args.workflow_args,
+               'warmups': args.warmups, 'configs': {}}
+    for (name, command) in configs.items():
+        trials = []
+        for i in range(args.warmups + args.trials):
+            warmup = i < args.warmups
+            sys.stderr.write('%s: %s #%d\n' %(name, 'warmup' if warmup else 'trial',
+                             i + 1 if warmup else i - args.warmups + 1))
+            trial = run_trial(command, args.workflow_args, work_dir, '%s-trace-%d' %(name, i))
+            if trial['exit_code'] != 0:
+                sys.stderr.write('  exited with status %d\n' %(trial['exit_code']))
+            elif trial['total'] != None:
+                sys.stderr.write('  %.2f seconds\n' %(trial['total']))
+            if not warmup:
+                trials.append(trial)
+        results['configs'][name] = {'command': command, 'trials': trials, 'summary': summarize(trials)}
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    report(results, sys.stdout)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline, args.threshold)
+        print('\nComparison with %s (%s)' %(args.baseline, baseline['environment'].get('date')))
+        print('%-12s %-16s %12s %12s %8s' %('config', 'metric', 'baseline (s)', 'current (s)', 'change'))
+        for row in rows:
+            print('%-12s %-16s %12.2f %12.2f %+7.1f%% %s' %(row[0], row[1], row[2], row[3], 100 * row[4], row[5]))
+        if any(row[5] == 'REGRESSION' for row in rows):
+            sys.exit(1)
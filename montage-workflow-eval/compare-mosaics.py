@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import sys
+
+import numpy as np
+from astropy.io import fits
+
+
+'''
+Function to compare a mosaic against a reference mosaic of the same
+field (e.g. a float32 run against a float64 run), returning a dictionary
+of statistics
+'''
+def compare_mosaics(test_fits, reference_fits):
+    test = fits.getdata(test_fits).astype(np.float64)
+    reference = fits.getdata(reference_fits).astype(np.float64)
+    if test.shape != reference.shape:
+        sys.stderr.write("Mosaics have different shapes: " + str(test.shape) + " and " +
+                         str(reference.shape) + "\n")
+        sys.exit(1)
+
+    valid = np.isfinite(test) & np.isfinite(reference)
+    diff = np.abs(test[valid] - reference[valid])
+    value_range = np.ptp(reference[valid]) if np.any(valid) else 0.0
+    scale = np.maximum(np.abs(reference[valid]), np.finfo(np.float32).tiny)
+
+    return {
+        'pixels': int(reference.size),
+        'compared pixels': int(np.count_nonzero(valid)),
+        'coverage mismatches': int(np.count_nonzero(np.isfinite(test) != np.isfinite(reference))),
+        'max abs diff': float(diff.max()) if diff.size > 0 else 0.0,
+        'rms diff': float(np.sqrt(np.mean(diff ** 2))) if diff.size > 0 else 0.0,
+        'max rel diff': float((diff / scale).max()) if diff.size > 0 else 0.0,
+        'max diff / range': float(diff.max() / value_range) if diff.size > 0 and value_range > 0 else 0.0,
+        'test file bytes': os.path.getsize(test_fits),
+        'reference file bytes': os.path.getsize(reference_fits),
+    }
+
+
+'''
+Main 
+'''
+
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('test', action = 'store',
+                        help = 'Mosaic to validate, for example a --pixel-type float32 mosaic')
+    parser.add_argument('reference', action = 'store',
+                        help = 'Reference mosaic, for example a --pixel-type float64 mosaic')
+    parser.add_argument('--tolerance', action = 'store', dest = 'tolerance', type = float, default = 1e-5,
+                        help = 'Largest accepted difference, relative to the reference value range')
+    args = parser.parse_args()
+
+    stats = compare_mosaics(args.test, args.reference)
+    for key in stats:
+        print("%-22s %s" %(key + ':', stats[key]))
+    print("%-22s %.2f" %('size ratio:', stats['test file bytes'] / float(stats['reference file bytes'])))
+
+    if stats['coverage mismatches'] > 0 or stats['max diff / range'] > args.tolerance:
+        print("FAILED: mosaics differ beyond a relative tolerance of %g" %(args.tolerance))
+        sys.exit(1)
+    print("OK: mosaics agree within a relative tolerance of %g" %(args.tolerance))
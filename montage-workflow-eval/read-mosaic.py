@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import importlib.util
+import sys
+
+import numpy as np
+from astropy.io import fits
+
+eval_dir = os.path.dirname(os.path.abspath(__file__))
+workflow_script = os.path.join(eval_dir, '..', 'montage-workflow-dask', 'montage-workflow-dask.py')
+
+
+'''
+Function to load read_mosaic from the workflow script, which reads the
+mosaics written with or without --compress-mosaic
+'''
+def load_reader():
+    spec = importlib.util.spec_from_file_location('montage_workflow_dask', workflow_script)
+    montage = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(montage)
+    return montage.read_mosaic
+
+
+'''
+Function to parse a START:STOP range of pixels, either bound being
+optional, into a slice
+'''
+def parse_range(text):
+    if text == None:
+        return slice(None)
+    (start, stop) = text.split(':')
+    return slice(int(start) if start else None, int(stop) if stop else None)
+
+
+'''
+Function to cut a section out of a mosaic, decompressing only the tiles
+it overlaps. Returns the pixels and a header whose WCS is shifted to the
+section
+'''
+def cutout(read_mosaic, path, rows, cols):
+    (data, header) = read_mosaic(path, rows, cols, header=True)
+    for (axis, section) in ((1, cols), (2, rows)):
+        if section.start != None and 'CRPIX%d' %(axis) in header:
+            header['CRPIX%d' %(axis)] = float(header['CRPIX%d' %(axis)]) - section.start
+    header['NAXIS1'] = data.shape[1]
+    header['NAXIS2'] = data.shape[0]
+    return (data, header)
+
+
+'''
+Main
+'''
+
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('mosaic', action = 'store',
+                        help = 'Mosaic to read, a .fits or a tile-compressed .fits.fz file')
+    parser.add_argument('--rows', action = 'store', dest = 'rows',
+                        help = 'Rows to read, as START:STOP in 0-based pixels (default: all)')
+    parser.add_argument('--cols', action = 'store', dest = 'cols',
+                        help = 'Columns to read, as START:STOP in 0-based pixels (default: all)')
+    parser.add_argument('--output', action = 'store', dest = 'output',
+                        help = 'Write the section to this (uncompressed) FITS file')
+    args = parser.parse_args()
+
+    (rows, cols) = (parse_range(args.rows), parse_range(args.cols))
+    if (rows.start != None and rows.start < 0) or (cols.start != None and cols.start < 0):
+        sys.stderr.write("Negative ranges are not supported\n")
+        sys.exit(1)
+
+    (data, header) = cutout(load_reader(), args.mosaic, rows, cols)
+    finite = data[np.isfinite(data)]
+    print('%s: %d x %d pixels, %.1f%% covered' %(args.mosaic, data.shape[1], data.shape[0],
+          100.0 * finite.size / data.size if data.size > 0 else 0.0))
+    if finite.size > 0:
+        print('min %g, median %g, max %g' %(finite.min(), np.median(finite), finite.max()))
+
+    if args.output:
+        fits.writeto(args.output, data, header, overwrite=True)
+        sys.stderr.write("Section written to " + args.output + "\n")
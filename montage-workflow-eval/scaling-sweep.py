@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import json
+import math
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+
+from benchmark import environment, stages_from_trace, total_re
+
+eval_dir = os.path.dirname(os.path.abspath(__file__))
+dask_script = os.path.join(eval_dir, '..', 'montage-workflow-dask', 'montage-workflow-dask.py')
+seq_script = os.path.join(eval_dir, 'montage-workflow-seq.py')
+
+# Stages that run as a single task per band, which no number of workers speeds up
+default_funnels = 'mConcatFit,mBgModel,mBgModelPy,mImgtbl,mAdd,mViewer,mViewerPy'
+
+
+'''
+Function to measure the union of a list of (start, end) intervals
+'''
+def covered_time(intervals):
+    total = 0.0
+    (start, end) = (None, None)
+    for (a, b) in sorted(intervals):
+        if end == None or a > end:
+            if end != None:
+                total += end - start
+            (start, end) = (a, b)
+        else:
+            end = max(end, b)
+    if end != None:
+        total += end - start
+    return total
+
+
+'''
+Function to split the makespan of a run into the time a serial funnel
+stage was running, the time only parallel stages were running, and
+the rest, when no task was running at all: scheduling, level barriers
+and data movement
+'''
+def breakdown(trace_file, makespan, funnels):
+    records = []
+    with open(trace_file) as f:
+        for line in f:
+            records.append(json.loads(line))
+    busy = covered_time([(r['start'], r['end']) for r in records])
+    serial = covered_time([(r['start'], r['end']) for r in records if r['executable'] in funnels])
+    return {
+        'serial': serial,
+        'parallel': busy - serial,
+        'overhead': max(makespan - busy, 0.0),
+    }
+
+
+'''
+Function to run the workflow once for a point of the sweep, returning
+its makespan and breakdown
+'''
+def run_point(point, workflow_args, work_dir, funnels, trial):
+    trace = os.path.join(work_dir, 'sweep-trace-%s-%d' %(point['name'], trial))
+    if point['workers'] == 0:
+        cmd = 'python3 %s %s --degrees %g' %(seq_script, workflow_args, point['degrees'])
+    else:
+        cmd = 'python3 %s %s --degrees %g --workers %d --threads-per-worker %d --trace %s' \
+              %(dask_script, workflow_args, point['degrees'], point['workers'], point['threads'], trace)
+    proc = subprocess.run(cmd, shell=True, cwd=work_dir, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True, errors='replace')
+    shutil.rmtree(os.path.join(work_dir, 'dask-worker-space'), ignore_errors=True)
+    match = total_re.search(proc.stderr)
+    if proc.returncode != 0 or not match:
+        sys.stderr.write('  %s failed with status %d\n' %(point['name'], proc.returncode))
+        return None
+    makespan = float(match.group(1))
+    result = {'makespan': makespan}
+    if os.path.isfile(trace + '.jsonl'):
+        result.update(breakdown(trace + '.jsonl', makespan, funnels))
+        result['stages'] = stages_from_trace(trace + '.jsonl')
+    return result
+
+
+'''
+Function to list the points of a sweep. Strong scaling keeps the field
+and grows the cluster; weak scaling grows the field area with the
+number of slots (workers times threads), so that each slot gets the
+same area. A sequential run, with no workers, can be the reference
+'''
+def sweep_points(mode, workers, threads, degrees, sequential):
+    points = []
+    if sequential:
+        points.append({'name': 'seq', 'workers': 0, 'threads': 1, 'slots': 1, 'degrees': degrees})
+    base_slots = min(workers) * min(threads)
+    for w in workers:
+        for t in threads:
+            slots = w * t
+            d = degrees if mode == 'strong' else degrees * math.sqrt(slots / float(base_slots))
+            points.append({'name': '%dx%d' %(w, t), 'workers': w, 'threads': t, 'slots': slots, 'degrees': d})
+    return points
+
+
+'''
+Function to compute the speedup and parallel efficiency of every point
+against the reference point (the first one that ran). For weak scaling the
+ideal is a constant makespan, so both are the ratio of makespans
+'''
+def scaling_table(mode, points):
+    measured = [point for point in points if point.get('makespan') != None]
+    if len(measured) == 0:
+        return points
+    reference = measured[0]
+    for point in points:
+        if point.get('makespan') == None:
+            continue
+        ratio = reference['makespan'] / point['makespan']
+        if mode == 'strong':
+            point['speedup'] = ratio
+            point['efficiency'] = ratio * reference['slots'] / point['slots']
+        else:
+            point['speedup'] = ratio * point['slots'] / reference['slots']
+            point['efficiency'] = ratio
+    return points
+
+
+'''
+Function to print the scaling table
+'''
+def report(mode, points, output):
+    output.write('%s scaling\n' %(mode))
+    output.write('%-8s %6s %8s %12s %8s %10s %10s %12s %12s\n' %('point', 'slots', 'degrees', 'makespan (s)',
+                 'speedup', 'efficiency', 'serial (s)', 'parallel (s)', 'overhead (s)'))
+    for point in points:
+        if point.get('makespan') == None:
+            output.write('%-8s %6d %8.2f %12s\n' %(point['name'], point['slots'], point['degrees'], 'failed'))
+            continue
+        output.write('%-8s %6d %8.2f %12.2f %8.2f %9.0f%% %10.2f %12.2f %12.2f\n' %(point['name'], point['slots'],
+                     point['degrees'], point['makespan'], point['speedup'], 100 * point['efficiency'],
+                     point.get('serial', float('nan')), point.get('parallel', float('nan')),
+                     point.get('overhead', float('nan'))))
+
+    # Amdahl's law from the first traced point bounds the speedup
+    traced = [point for point in points if point.get('serial') != None and point.get('makespan')]
+    if mode == 'strong' and len(traced) > 0:
+        reference = traced[0]
+        serial_fraction = reference['serial'] / reference['makespan']
+        output.write('Serial fraction at %s: %.1f%%, speedup bound %.1f\n' %(reference['name'],
+                     100 * serial_fraction, 1.0 / serial_fraction if serial_fraction > 0 else float('inf')))
+
+
+'''
+Function to plot speedup, efficiency and the makespan breakdown, if
+matplotlib is available
+'''
+def plot(mode, points, prefix):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        sys.stderr.write('matplotlib is not installed, skipping the plots\n')
+        return
+    points = [p for p in points if p.get('makespan') != None]
+    names = [p['name'] for p in points]
+    slots = [p['slots'] for p in points]
+
+    (fig, axes) = plt.subplots(1, 3, figsize=(15, 4))
+    axes[0].plot(slots, [p['speedup'] for p in points], 'o-', label='measured')
+    axes[0].plot(slots, [s / float(points[0]['slots']) for s in slots], 'k--', label='ideal')
+    axes[0].set_xlabel('slots')
+    axes[0].set_ylabel('speedup')
+    axes[0].legend()
+    axes[1].plot(slots, [100 * p['efficiency'] for p in points], 'o-')
+    axes[1].set_xlabel('slots')
+    axes[1].set_ylabel('parallel efficiency (%)')
+    axes[1].set_ylim(0, 110)
+    bottom = np.zeros(len(points))
+    for part in ('parallel', 'serial', 'overhead'):
+        values = np.array([p.get(part, 0.0) for p in points])
+        axes[2].bar(names, values, bottom=bottom, label=part)
+        bottom += values
+    axes[2].set_ylabel('makespan (s)')
+    axes[2].legend()
+    fig.suptitle('%s scaling' %(mode))
+    fig.tight_layout()
+    fig.savefig(prefix + '-' + mode + '.png')
+    sys.stderr.write('Plots written to ' + prefix + '-' + mode + '.png\n')
+
+
+'''
+Main
+'''
+
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--mode', action = 'store', dest = 'mode', default = 'strong',
+                        choices = ['strong', 'weak'], help = 'Strong or weak scaling')
+    parser.add_argument('--workers', action = 'store', dest = 'workers', default = '1,2,4,8',
+                        help = 'Comma-separated numbers of Dask workers')
+    parser.add_argument('--threads-per-worker', action = 'store', dest = 'threads', default = '1',
+                        help = 'Comma-separated numbers of threads per worker')
+    parser.add_argument('--degrees', action = 'store', dest = 'degrees', type = float, default = 1.0,
+                        help = 'Field size, for weak scaling the one of the smallest cluster')
+    parser.add_argument('--args', action = 'store', dest = 'workflow_args',
+                        default = '--center "56.7 24.0" --band dss:DSS2B:red',
+                        help = 'Other workflow arguments')
+    parser.add_argument('--sequential', action = 'store_true', dest = 'sequential',
+                        help = 'Run the sequential workflow too, as the reference point')
+    parser.add_argument('--funnels', action = 'store', dest = 'funnels', default = default_funnels,
+                        help = 'Comma-separated executables counted as serial funnels')
+    parser.add_argument('--trials', action = 'store', dest = 'trials', type = int, default = 3,
+                        help = 'Runs per point, the median is reported')
+    parser.add_argument('--work-dir', action = 'store', dest = 'work_dir', default = '.',
+                        help = 'Directory to run the workflows in')
+    parser.add_argument('--output', action = 'store', dest = 'output', default = 'scaling.json',
+                        help = 'JSON file to write the results to')
+    parser.add_argument('--plot', action = 'store', dest = 'plot',
+                        help = 'Prefix of the PNG plots')
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir)
+    funnels = set(args.funnels.split(','))
+    points = sweep_points(args.mode, [int(w) for w in args.workers.split(',')],
+                          [int(t) for t in args.threads.split(',')], args.degrees, args.sequential)
+
+    for point in points:
+        runs = []
+        for trial in range(args.trials):
+            sys.stderr.write('%s (%.2f degrees) trial #%d\n' %(point['name'], point['degrees'], trial + 1))
+            run = run_point(point, args.workflow_args, work_dir, funnels, trial)
+            if run != None:
+                runs.append(run)
+        point['runs'] = runs
+        for key in ('makespan', 'serial', 'parallel', 'overhead'):
+            values = [run[key] for run in runs if key in run]
+            if len(values) > 0:
+                point[key] = float(np.median(values))
+
+    scaling_table(args.mode, points)
+    report(args.mode, points, sys.stdout)
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'mode': args.mode, 'workflow args': args.workflow_args,
+                   'funnels': sorted(funnels), 'points': points}, f, indent=2)
+    if args.plot:
+        plot(args.mode, points, args.plot)
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import heapq
+import importlib.util
+import json
+import sys
+
+import numpy as np
+
+eval_dir = os.path.dirname(os.path.abspath(__file__))
+
+policies = ['level', 'dag', 'critical-path', 'clustering']
+
+
+'''
+Function to load a workflow plan saved with --save-plan by the Dask
+script
+'''
+def load_plan(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+'''
+Function to plan a synthetic workflow with the shape of add_band, as
+synthetic-benchmark.py does, taking the durations and output sizes
+from its stage profiles at full scale
+'''
+def synthetic_plan(bands, plates, overlap_density):
+    spec = importlib.util.spec_from_file_location('synthetic_benchmark',
+                                                  os.path.join(eval_dir, 'synthetic-benchmark.py'))
+    synthetic = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(synthetic)
+    montage = synthetic.load_modules(False)
+    (wf, raw_files) = synthetic.synthetic_workflow(montage, bands, plates, overlap_density, (1.0, 1.0, 1.0))
+
+    tasks = []
+    for task in wf.tasks:
+        arguments = task.arguments
+        sizes = {}
+        for (flag, value) in zip(arguments, arguments[1:]):
+            if flag == '--output':
+                (f, size) = value.rsplit(':', 1)
+                sizes[f] = int(size)
+        tasks.append({'executable': task.executable, 'band': task.band, 'priority': task.priority,
+                      'inputs': task.inputfiles, 'outputs': task.outputfiles, 'stage_out': [],
+                      'duration': float(arguments[arguments.index('--cpu') + 1]), 'output_sizes': sizes})
+    input_sizes = dict((f, synthetic.raw_plate_bytes) for f in raw_files)
+    return {'tasks': tasks, 'input_sizes': input_sizes}
+
+
+'''
+Function to learn per-executable models from task traces written with
+--trace: the duration is fitted as linear in the input bytes when the
+inputs vary enough, and is the median duration otherwise. The output
+size is the median one
+'''
+def fit_models(trace_files):
+    samples = {}
+    for trace_file in trace_files:
+        with open(trace_file) as f:
+            for line in f:
+                record = json.loads(line)
+                samples.setdefault(record['executable'], []).append(
+                    (record['input_bytes'], record['end'] - record['start'], record['output_bytes']))
+
+    models = {}
+    for (executable, rows) in samples.items():
+        x = np.array([row[0] for row in rows], dtype=float)
+        y = np.array([row[1] for row in rows], dtype=float)
+        model = {'median': float(np.median(y)), 'slope': 0.0, 'intercept': float(np.median(y)),
+                 'output_bytes': float(np.median([row[2] for row in rows])), 'samples': len(rows)}
+        if len(np.unique(x)) >= 3:
+            (slope, intercept) = np.polyfit(x, y, 1)
+            if slope > 0:
+                (model['slope'], model['intercept']) = (float(slope), float(intercept))
+        models[executable] = model
+    return models
+
+
+'''
+Function to predict the duration and output sizes of every task of a
+plan, propagating the predicted sizes of intermediate files to the
+inputs of their consumers. The plan lists the tasks in dependency order
+'''
+def predict(plan, models, default_duration):
+    sizes = dict(plan['input_sizes'])
+    durations = []
+    for task in plan['tasks']:
+        input_bytes = sum(sizes.get(f, 0) for f in task['inputs'])
+        model = models.get(task['executable'])
+        if 'duration' in task and model == None:
+            duration = task['duration']
+        elif model != None:
+            duration = max(model['intercept'] + model['slope'] * input_bytes, 0.0)
+        else:
+            duration = default_duration
+        durations.append(duration)
+
+        if 'output_sizes' in task and model == None:
+            sizes.update(task['output_sizes'])
+        elif model != None and len(task['outputs']) > 0:
+            for f in task['outputs']:
+                sizes[f] = model['output_bytes'] / len(task['outputs'])
+    return (durations, sizes)
+
+
+'''
+Function to compute the level of every task as Workflow.run does: a
+task is submitted with the first level after the ones producing all
+of its inputs
+'''
+def task_levels(tasks, producer):
+    levels = []
+    for task in tasks:
+        level = 0
+        for f in task['inputs']:
+            if f in producer:
+                level = max(level, levels[producer[f]] + 1)
+        levels.append(level)
+    return levels
+
+
+'''
+Function to group the tasks into the units the scheduler dispatches.
+With clustering, tasks of the same executable and level are grouped by
+cluster_size, each group paying the per-task overhead once. Tasks that
+don't wait for the level barrier are only clustered together
+'''
+def make_units(plan, durations, cluster_size):
+    tasks = plan['tasks']
+    producer = {}
+    for (i, task) in enumerate(tasks):
+        for f in task['outputs']:
+            producer[f] = i
+    levels = task_levels(tasks, producer)
+
+    groups = []
+    if cluster_size > 1:
+        open_groups = {}
+        for (i, task) in enumerate(tasks):
+            key = (task['executable'], levels[i], task.get('wait_for_level', True))
+            if key not in open_groups or len(groups[open_groups[key]]) == cluster_size:
+                open_groups[key] = len(groups)
+                groups.append([])
+            groups[open_groups[key]].append(i)
+    else:
+        groups = [[i] for i in range(len(tasks))]
+
+    unit_of = {}
+    for (u, group) in enumerate(groups):
+        for i in group:
+            unit_of[i] = u
+    units = []
+    for (u, group) in enumerate(groups):
+        inputs = []
+        outputs = []
+        for i in group:
+            inputs.extend(tasks[i]['inputs'])
+            outputs.extend(tasks[i]['outputs'])
+        deps = set(unit_of[producer[f]] for f in inputs if f in producer) - set([u])
+        units.append({'duration': sum(durations[i] for i in group), 'deps': deps,
+                      'level': max(levels[i] for i in group),
+                      'wait_for_level': any(tasks[i].get('wait_for_level', True) for i in group),
+                      'priority': max(tasks[i]['priority'] for i in group),
+                      'inputs': inputs, 'outputs': outputs})
+    return units
+
+
+'''
+Function to compute the upward rank of every unit: its duration plus
+the longest chain of successors, the priority of critical-path
+scheduling
+'''
+def upward_ranks(units, successors):
+    ranks = [0.0] * len(units)
+    for u in reversed(range(len(units))):
+        ranks[u] = units[u]['duration'] + max([ranks[s] for s in successors[u]], default=0.0)
+    return ranks
+
+
+'''
+Function to simulate the execution of the units on the given number of
+slots under a scheduling policy, returning the makespan, utilization
+and peak disk usage of intermediate files, released once their last
+consumer is done as with --gc-intermediates
+'''
+def simulate(units, sizes, final_files, slots, policy, overhead):
+    successors = [[] for u in units]
+    waiting = []
+    for (u, unit) in enumerate(units):
+        waiting.append(len(unit['deps']))
+        for d in unit['deps']:
+            successors[d].append(u)
+    if policy == 'critical-path':
+        ranks = upward_ranks(units, successors)
+        key = lambda u: (-ranks[u], u)
+    else:
+        key = lambda u: (-units[u]['priority'], u)
+
+    consumers = {}
+    for unit in units:
+        for f in set(unit['inputs']):
+            consumers[f] = consumers.get(f, 0) + 1
+    produced = set(f for unit in units for f in unit['outputs'])
+
+    # units that don't wait for the level barrier don't hold it either
+    level_left = {}
+    for unit in units:
+        if unit['wait_for_level']:
+            level_left[unit['level']] = level_left.get(unit['level'], 0) + 1
+    current_level = min(level_left) if len(level_left) > 0 else 0
+    held = []
+
+    ready = []
+    for (u, unit) in enumerate(units):
+        if waiting[u] == 0:
+            if policy == 'level' and unit['wait_for_level'] and unit['level'] != current_level:
+                held.append(u)
+            else:
+                heapq.heappush(ready, (key(u), u))
+
+    (now, busy, disk, peak_disk, free) = (0.0, 0.0, 0.0, 0.0, slots)
+    running = []
+    done = 0
+    while done < len(units):
+        while free > 0 and len(ready) > 0:
+            (k, u) = heapq.heappop(ready)
+            duration = units[u]['duration'] + overhead
+            busy += duration
+            heapq.heappush(running, (now + duration, u))
+            free -= 1
+        if len(running) == 0:
+            sys.stderr.write('Simulation stalled, the plan has a dependency cycle\n')
+            sys.exit(1)
+
+        (now, u) = heapq.heappop(running)
+        free += 1
+        done += 1
+        unit = units[u]
+        for f in unit['outputs']:
+            disk += sizes.get(f, 0)
+        peak_disk = max(peak_disk, disk)
+        for f in set(unit['inputs']):
+            consumers[f] -= 1
+            if consumers[f] == 0 and f in produced and f not in final_files:
+                disk -= sizes.get(f, 0)
+
+        for s in successors[u]:
+            waiting[s] -= 1
+            if waiting[s] == 0:
+                if policy == 'level' and units[s]['wait_for_level'] and units[s]['level'] != current_level:
+                    held.append(s)
+                else:
+                    heapq.heappush(ready, (key(s), s))
+        if policy == 'level' and unit['wait_for_level']:
+            level_left[unit['level']] -= 1
+            if level_left[unit['level']] == 0 and unit['level'] == current_level:
+                # the barrier opens on the next level
+                remaining = [level for level in level_left if level_left[level] > 0]
+                if len(remaining) > 0:
+                    current_level = min(remaining)
+                    for s in [s for s in held if units[s]['level'] == current_level]:
+                        heapq.heappush(ready, (key(s), s))
+                    held = [s for s in held if units[s]['level'] != current_level]
+
+    return {
+        'makespan': now,
+        'utilization': busy / (now * slots) if now > 0 else 0.0,
+        'peak disk': peak_disk,
+        'dispatched': len(units),
+    }
+
+
+'''
+Main
+'''
+
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--plan', action = 'store', dest = 'plan',
+                        help = 'Workflow plan saved with the --save-plan option of montage-workflow-dask.py')
+    parser.add_argument('--synthetic', action = 'store', dest = 'synthetic',
+                        help = 'Simulate a synthetic workflow instead, as BANDS,PLATES,OVERLAPS_PER_PLATE')
+    parser.add_argument('--trace', action = 'append', dest = 'traces', default = [],
+                        help = 'Task trace (.jsonl) to learn the duration models from, can be repeated')
+    parser.add_argument('--default-duration', action = 'store', dest = 'default_duration', type = float,
+                        default = 1.0, help = 'Duration of the executables missing from the traces, in seconds')
+    parser.add_argument('--workers', action = 'store', dest = 'workers', default = '1,2,4,8,16',
+                        help = 'Comma-separated numbers of slots to simulate')
+    parser.add_argument('--policies', action = 'store', dest = 'policies', default = ','.join(policies),
+                        help = 'Comma-separated policies among ' + ', '.join(policies))
+    parser.add_argument('--cluster-size', action = 'store', dest = 'cluster_size', type = int, default = 8,
+                        help = 'Tasks per cluster with the clustering policy')
+    parser.add_argument('--task-overhead', action = 'store', dest = 'overhead', type = float, default = 0.01,
+                        help = 'Scheduling overhead of every dispatched task or cluster, in seconds')
+    parser.add_argument('--json', action = 'store', dest = 'json',
+                        help = 'Write the predictions to this JSON file')
+    args = parser.parse_args()
+
+    if args.plan:
+        plan = load_plan(args.plan)
+    elif args.synthetic:
+        (bands, plates, density) = args.synthetic.split(',')
+        plan = synthetic_plan(int(bands), int(plates), float(density))
+    else:
+        sys.stderr.write("--plan or --synthetic argument required\n")
+        sys.exit(1)
+
+    models = fit_models(args.traces)
+    (durations, sizes) = predict(plan, models, args.default_duration)
+    final_files = set(f for task in plan['tasks'] for f in task['stage_out'])
+    sys.stderr.write('%d tasks, %.1f seconds of work, %d executables modelled from traces\n'
+                     %(len(plan['tasks']), sum(durations), len(models)))
+
+    results = []
+    print('%-14s %6s %12s %12s %14s %10s' %('policy', 'slots', 'makespan (s)', 'utilization',
+                                            'peak disk (MB)', 'dispatched'))
+    for policy in args.policies.split(','):
+        if policy not in policies:
+            sys.stderr.write("Unknown policy " + policy + "\n")
+            sys.exit(1)
+        units = make_units(plan, durations, args.cluster_size if policy == 'clustering' else 1)
+        for slots in [int(w) for w in args.workers.split(',')]:
+            result = simulate(units, sizes, final_files, slots, policy, args.overhead)
+            result.update({'policy': policy, 'slots': slots})
+            results.append(result)
+            print('%-14s %6d %12.1f %11.0f%% %14.1f %10d' %(policy, slots, result['makespan'],
+                  100 * result['utilization'], result['peak disk'] / 1e6, result['dispatched']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'models': models, 'tasks': len(plan['tasks']), 'results': results}, f, indent=2)
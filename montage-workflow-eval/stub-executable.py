@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import sys
+import time
+
+
+'''
+Function to mimic the cost of a Montage executable: hold on to some
+memory, burn CPU for a while, read the inputs and write outputs of
+the given sizes. It is shared by the stub command below and by the
+in-process stubs of synthetic-benchmark.py
+'''
+def mimic(cpu, memory, inputs, outputs, clock=time.process_time):
+    # touch every page so that the memory is actually resident
+    ballast = bytearray(int(memory * 1024 * 1024))
+    for i in range(0, len(ballast), 4096):
+        ballast[i] = 1
+
+    for f in inputs:
+        if os.path.isfile(f):
+            with open(f, 'rb') as stream:
+                while stream.read(1 << 20):
+                    pass
+
+    deadline = clock() + cpu
+    x = 0
+    while clock() < deadline:
+        for i in range(10000):
+            x += i * i
+
+    block = b'\0' * (1 << 20)
+    for (f, size) in outputs:
+        with open(f, 'wb') as stream:
+            while size > 0:
+                stream.write(block[:min(size, len(block))])
+                size -= len(block)
+    return x
+
+
+'''
+Function to parse the stub's command-line arguments
+'''
+def parse_args(arguments):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cpu', action = 'store', dest = 'cpu', type = float, default = 0.0,
+                        help = 'CPU seconds to burn')
+    parser.add_argument('--memory', action = 'store', dest = 'memory', type = float, default = 0.0,
+                        help = 'Memory to allocate, in MiB')
+    parser.add_argument('--input', action = 'append', dest = 'inputs', default = [],
+                        help = 'Input file to read')
+    parser.add_argument('--output', action = 'append', dest = 'outputs', default = [],
+                        help = 'Output file to write, as FILE:BYTES')
+    args = parser.parse_args(arguments)
+    outputs = []
+    for output in args.outputs:
+        (f, size) = output.rsplit(':', 1)
+        outputs.append((f, int(size)))
+    return (args, outputs)
+
+
+'''
+Function registered as an in-process executable of the Dask workflow,
+burning the CPU time of the worker thread rather than of a process.
+File names are relative to the data directory of the data plane
+'''
+def run_in_process(plane, *arguments):
+    (args, outputs) = parse_args(list(arguments))
+    mimic(args.cpu, args.memory, [plane.path(f) for f in args.inputs],
+          [(plane.path(f), size) for (f, size) in outputs], clock=time.thread_time)
+
+
+'''
+Main
+'''
+
+if __name__ == '__main__':
+
+    (args, outputs) = parse_args(sys.argv[1:])
+    mimic(args.cpu, args.memory, args.inputs, outputs)
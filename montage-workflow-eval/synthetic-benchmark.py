@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import importlib.util
+import json
+import math
+import stat
+import sys
+import time
+
+from dask.distributed import Client, LocalCluster
+from distributed.diagnostics.plugin import WorkerPlugin
+
+eval_dir = os.path.dirname(os.path.abspath(__file__))
+workflow_script = os.path.join(eval_dir, '..', 'montage-workflow-dask', 'montage-workflow-dask.py')
+stub_script = os.path.join(eval_dir, 'stub-executable.py')
+
+# Cost of one task of each stage for a 1-degree DSS plate: CPU seconds,
+# memory in MiB and output sizes in bytes. These are scaled down by the
+# --cpu-scale, --memory-scale and --size-scale options
+stage_profiles = {
+    'mProject':    {'cpu': 4.0, 'memory': 300, 'outputs': [16000000, 16000000]},
+    'mDiffFit':    {'cpu': 0.5, 'memory': 100, 'outputs': [1000]},
+    'mConcatFit':  {'cpu': 0.2, 'memory': 50,  'outputs': [100000]},
+    'mBgModel':    {'cpu': 2.0, 'memory': 50,  'outputs': [10000]},
+    'mBackground': {'cpu': 0.5, 'memory': 150, 'outputs': [16000000]},
+    'mImgtbl':     {'cpu': 0.2, 'memory': 20,  'outputs': [50000]},
+    'mAdd':        {'cpu': 5.0, 'memory': 500, 'outputs': [64000000, 64000000]},
+    'mViewer':     {'cpu': 1.0, 'memory': 200, 'outputs': [2000000]},
+}
+raw_plate_bytes = 8000000
+
+# Neighbour offsets on the plate grid, nearest first
+overlap_offsets = [(1, 0), (0, 1), (1, 1), (-1, 1), (2, 0), (0, 2), (2, 1), (1, 2),
+                   (-1, 2), (-2, 1), (2, 2), (-2, 2)]
+
+
+'''
+Function to load one of the hyphen-named scripts as a module, under
+a name that workers can unpickle tasks from
+'''
+def load_script(name, path):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+'''
+Function to load the workflow and stub modules, registering the stub
+as the in-process implementation of every stage if asked to
+'''
+def load_modules(in_process):
+    montage = load_script('montage_workflow_dask', workflow_script)
+    stub = load_script('montage_stub_executable', stub_script)
+    if in_process:
+        for stage in stage_profiles:
+            montage.in_process_executables[stage] = stub.run_in_process
+    return montage
+
+
+'''
+Worker plugin loading the modules on every Dask worker
+'''
+class LoadModules(WorkerPlugin):
+    def __init__(self, in_process, quiet):
+        self.in_process = in_process
+        self.quiet = quiet
+
+    def setup(self, worker):
+        load_modules(self.in_process)
+        if self.quiet:
+            sys.stderr = open(os.devnull, 'w')
+
+
+'''
+Function to list the overlapping pairs of a square-ish grid of plates,
+nearest neighbours first, until the requested average number of
+overlaps per plate is reached
+'''
+def plate_pairs(plates, overlap_density):
+    side = int(math.ceil(math.sqrt(plates)))
+    wanted = int(round(plates * overlap_density / 2))
+    pairs = []
+    for (dx, dy) in overlap_offsets:
+        for i in range(plates):
+            (x, y) = (i % side + dx, i // side + dy)
+            j = y * side + x
+            if 0 <= x < side and j < plates:
+                pairs.append((i, j))
+                if len(pairs) == wanted:
+                    return pairs
+    return pairs
+
+
+'''
+Function to create a stub task of the given stage
+'''
+def stub_task(montage, stage, inputs, outputs, scales):
+    profile = stage_profiles[stage]
+    (cpu_scale, memory_scale, size_scale) = scales
+    j = montage.Task(stage)
+    j.add_inputs(*inputs)
+    j.add_outputs(*outputs, stage_out=False)
+    j.add_args('--cpu', '%g' %(profile['cpu'] * cpu_scale),
+               '--memory', '%g' %(profile['memory'] * memory_scale))
+    for f in inputs:
+        j.add_args('--input', f)
+    for (f, size) in zip(outputs, profile['outputs']):
+        j.add_args('--output', '%s:%d' %(f, int(size * size_scale)))
+    return j
+
+
+'''
+Function to generate a synthetic workflow with the shape of add_band
+in montage-workflow-dask.py, for the given number of bands, plates per
+band and overlaps per plate. Returns the workflow and its input files
+'''
+def synthetic_workflow(montage, bands, plates, overlap_density, scales):
+    wf = montage.Workflow('synthetic')
+    raw_files = []
+    pairs = plate_pairs(plates, overlap_density)
+    for band_id in range(1, bands + 1):
+        first_task = len(wf.tasks)
+        raw = ['%d-raw_%d.fits' %(band_id, i) for i in range(plates)]
+        projected = ['%d-p-%d.fits' %(band_id, i) for i in range(plates)]
+        area = ['%d-p-%d_area.fits' %(band_id, i) for i in range(plates)]
+        corrected = ['%d-c-%d.fits' %(band_id, i) for i in range(plates)]
+        raw_files.extend(raw)
+
+        for i in range(plates):
+            wf.add_tasks(stub_task(montage, 'mProject', [raw[i]], [projected[i], area[i]], scales))
+
+        fit_files = []
+        for (a, b) in pairs:
+            fit_files.append('%d-fit.%06d.%06d.txt' %(band_id, a, b))
+            wf.add_tasks(stub_task(montage, 'mDiffFit',
+                                   [projected[a], area[a], projected[b], area[b]],
+                                   [fit_files[-1]], scales))
+
+        fits_tbl = '%d-fits.tbl' %(band_id)
+        corrections_tbl = '%d-corrections.tbl' %(band_id)
+        wf.add_tasks(stub_task(montage, 'mConcatFit', fit_files, [fits_tbl], scales))
+        wf.add_tasks(stub_task(montage, 'mBgModel', [fits_tbl], [corrections_tbl], scales))
+
+        for i in range(plates):
+            wf.add_tasks(stub_task(montage, 'mBackground', [projected[i], area[i], corrections_tbl],
+                                   [corrected[i]], scales))
+
+        cimages_tbl = '%d-cimages.tbl' %(band_id)
+        mosaic = '%d-mosaic.fits' %(band_id)
+        wf.add_tasks(stub_task(montage, 'mImgtbl', corrected, [cimages_tbl], scales))
+        wf.add_tasks(stub_task(montage, 'mAdd', [cimages_tbl] + corrected + area,
+                               [mosaic, '%d-mosaic_area.fits' %(band_id)], scales))
+        wf.add_tasks(stub_task(montage, 'mViewer', [mosaic], ['%d-mosaic.png' %(band_id)], scales))
+
+        for task in wf.tasks[first_task:]:
+            task.band = str(band_id)
+    return (wf, raw_files)
+
+
+'''
+Function to create the input plates, and the stub commands named after
+the Montage executables in a bin/ directory
+'''
+def prepare_work_dir(raw_files, size_scale):
+    if not os.path.isdir('data'):
+        os.mkdir('data')
+    size = int(raw_plate_bytes * size_scale)
+    for f in raw_files:
+        path = os.path.join('data', f)
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            with open(path, 'wb') as stream:
+                stream.write(b'\0' * size)
+
+    if not os.path.isdir('bin'):
+        os.mkdir('bin')
+    for stage in stage_profiles:
+        path = os.path.join('bin', stage)
+        with open(path, 'w') as stream:
+            stream.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' %(sys.executable, stub_script))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ['PATH'] = os.path.abspath('bin') + os.pathsep + os.environ['PATH']
+
+
+'''
+Function to run the workflow one task after the other in this process
+'''
+def run_sequential(wf):
+    traces = []
+    for task in wf.tasks:
+        traces.append(task.run()['trace'])
+    return traces
+
+
+'''
+Function to summarize a run: the busy time of the tasks against the
+time the slots were available tells the scheduling overhead apart
+'''
+def summarize(traces, makespan, slots):
+    busy = sum(record['end'] - record['start'] for record in traces)
+    idle = max(makespan * slots - busy, 0.0)
+    return {
+        'tasks': len(traces),
+        'makespan': makespan,
+        'slots': slots,
+        'busy': busy,
+        'throughput': len(traces) / makespan if makespan > 0 else 0.0,
+        'utilization': busy / (makespan * slots) if makespan > 0 else 0.0,
+        'overhead per task': idle / len(traces) if len(traces) > 0 else 0.0,
+    }
+
+
+'''
+Main
+'''
+
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--bands', action = 'store', dest = 'bands', type = int, default = 1,
+                        help = 'Number of bands')
+    parser.add_argument('--plates', action = 'store', dest = 'plates', type = int, default = 100,
+                        help = 'Number of plates per band')
+    parser.add_argument('--overlap-density', action = 'store', dest = 'overlap_density', type = float,
+                        default = 4.0, help = 'Average number of overlaps per plate')
+    parser.add_argument('--backend', action = 'store', dest = 'backend', default = 'dask',
+                        choices = ['dask', 'sequential'],
+                        help = 'Executor backend: the Dask workflow runner, or one task after the other')
+    parser.add_argument('--stubs', action = 'store', dest = 'stubs', default = 'process',
+                        choices = ['process', 'in-process'],
+                        help = 'Run the stubs as commands, or as in-process executables of the workers')
+    parser.add_argument('--workers', action = 'store', dest = 'workers', type = int, default = None,
+                        help = 'Number of Dask workers')
+    parser.add_argument('--threads-per-worker', action = 'store', dest = 'threads_per_worker', type = int,
+                        default = None, help = 'Number of threads per Dask worker')
+    parser.add_argument('--cpu-scale', action = 'store', dest = 'cpu_scale', type = float, default = 0.01,
+                        help = 'Scale of the CPU time of the stage profiles')
+    parser.add_argument('--memory-scale', action = 'store', dest = 'memory_scale', type = float, default = 0.1,
+                        help = 'Scale of the memory of the stage profiles')
+    parser.add_argument('--size-scale', action = 'store', dest = 'size_scale', type = float, default = 0.001,
+                        help = 'Scale of the file sizes of the stage profiles')
+    parser.add_argument('--work-dir', action = 'store', dest = 'work_dir', default = 'synthetic-work',
+                        help = 'Work directory for the stub files')
+    parser.add_argument('--trace', action = 'store', dest = 'trace',
+                        help = 'Write the task trace to TRACE.jsonl and TRACE.json (Dask backend)')
+    parser.add_argument('--json', action = 'store', dest = 'json',
+                        help = 'Append the results as a JSON line to this file')
+    parser.add_argument('--quiet', action = 'store_true', dest = 'quiet',
+                        help = 'Silence the per-task messages')
+    args = parser.parse_args()
+
+    in_process = args.stubs == 'in-process'
+    montage = load_modules(in_process)
+    scales = (args.cpu_scale, args.memory_scale, args.size_scale)
+
+    start = time.perf_counter()
+    (wf, raw_files) = synthetic_workflow(montage, args.bands, args.plates, args.overlap_density, scales)
+    generated = time.perf_counter() - start
+    sys.stderr.write("Generated " + str(len(wf.tasks)) + " tasks in " + "{:.2f}".format(generated) + " seconds\n")
+
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    if args.trace:
+        montage.trace_prefix = os.path.abspath(args.trace)
+    if not os.path.isdir(args.work_dir):
+        os.makedirs(args.work_dir)
+    os.chdir(args.work_dir)
+    prepare_work_dir(raw_files, args.size_scale)
+
+    if args.backend == 'sequential':
+        slots = 1
+        if args.quiet:
+            sys.stderr = open(os.devnull, 'w')
+        start = time.perf_counter()
+        traces = run_sequential(wf)
+        makespan = time.perf_counter() - start
+        sys.stderr = sys.__stderr__
+    else:
+        cluster = LocalCluster(n_workers=args.workers, threads_per_worker=args.threads_per_worker)
+        client = Client(cluster)
+        client.register_plugin(LoadModules(in_process, args.quiet))
+        slots = sum(client.nthreads().values())
+        start = time.perf_counter()
+        wf.run()
+        makespan = time.perf_counter() - start
+        traces = wf.traces
+        client.close()
+        cluster.close()
+
+    results = summarize(traces, makespan, slots)
+    results.update({'backend': args.backend, 'stubs': args.stubs, 'bands': args.bands,
+                    'plates': args.plates, 'overlap density': args.overlap_density,
+                    'generation': generated})
+    for key in results:
+        print("%-20s %s" %(key + ':', results[key]))
+    if args.json:
+        with open(args.json, 'a') as f:
+            f.write(json.dumps(results) + '\n')
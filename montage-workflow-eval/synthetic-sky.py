@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import math
+import sys
+
+import numpy as np
+from astropy.io import ascii, fits
+from astropy.table import Table
+from astropy.wcs import WCS
+
+
+'''
+Function to make a TAN WCS centered on (ra, dec), with square pixels
+of cdelt degrees and the given rotation
+'''
+def tan_wcs(ra, dec, naxis, cdelt, crota2=0.0):
+    w = WCS(naxis=2)
+    w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    w.wcs.crval = [ra, dec]
+    w.wcs.crpix = [(naxis + 1) / 2.0, (naxis + 1) / 2.0]
+    w.wcs.cdelt = [-cdelt, cdelt]
+    w.wcs.crota = [0.0, crota2]
+    w.wcs.equinox = 2000.0
+    return w
+
+
+'''
+Function to lay plates out on a grid covering the field, adjacent
+plates sharing the given fraction of their width, with a little
+jitter and rotation as on real surveys. Returns (ra, dec, crota2)
+for every plate
+'''
+def plate_layout(ra0, dec0, degrees, plate_degrees, overlap, rng):
+    step = plate_degrees * (1.0 - overlap)
+    count = int(math.ceil((degrees + plate_degrees) / step))
+    # the field's tangent plane, in degrees
+    field = tan_wcs(ra0, dec0, 1, 1.0)
+    plates = []
+    for iy in range(count):
+        for ix in range(count):
+            x = (ix - (count - 1) / 2.0) * step + rng.normal(0.0, 0.02 * step)
+            y = (iy - (count - 1) / 2.0) * step + rng.normal(0.0, 0.02 * step)
+            (ra, dec) = field.wcs_pix2world([[1.0 - x, 1.0 + y]], 1)[0]
+            plates.append((float(ra) % 360.0, float(dec), float(rng.normal(0.0, 0.3))))
+    return plates
+
+
+'''
+Function to draw the stars of the field: positions uniform on the
+tangent plane and magnitudes following a power-law number count
+'''
+def star_catalog(ra0, dec0, degrees, density, rng):
+    count = int(density * degrees ** 2)
+    field = tan_wcs(ra0, dec0, 1, 1.0)
+    x = rng.uniform(-degrees / 2.0, degrees / 2.0, count)
+    y = rng.uniform(-degrees / 2.0, degrees / 2.0, count)
+    sky = field.wcs_pix2world(np.column_stack([1.0 - x, 1.0 + y]), 1)
+    # N(<flux) ~ flux^-1.5, the Euclidean source counts
+    flux = 200.0 * (1.0 - rng.uniform(0.0, 1.0, count)) ** (-1.0 / 1.5)
+    return (sky[:, 0], sky[:, 1], np.minimum(flux, 1e6))
+
+
+'''
+Function to render one plate: stars through a Gaussian PSF, a sky
+level with a per-plate offset and gradient, which background matching
+has to remove, and noise
+'''
+def render_plate(w, naxis, stars, fwhm, background, rng):
+    (ra, dec, flux) = stars
+    (px, py) = w.wcs_world2pix(ra, dec, 0)
+    radius = int(math.ceil(2 * fwhm))
+    inside = (px > -radius) & (px < naxis + radius) & (py > -radius) & (py < naxis + radius)
+    data = np.zeros((naxis, naxis), dtype=np.float32)
+
+    sigma = fwhm / 2.3548
+    offsets = np.arange(-radius, radius + 1)
+    for (x, y, f) in zip(px[inside], py[inside], flux[inside]):
+        (ix, iy) = (int(round(x)), int(round(y)))
+        xs = offsets + ix
+        ys = offsets + iy
+        stamp = np.outer(np.exp(-0.5 * ((ys - y) / sigma) ** 2), np.exp(-0.5 * ((xs - x) / sigma) ** 2))
+        stamp *= f / (2 * math.pi * sigma ** 2)
+        (x0, x1) = (max(xs[0], 0), min(xs[-1] + 1, naxis))
+        (y0, y1) = (max(ys[0], 0), min(ys[-1] + 1, naxis))
+        if x0 < x1 and y0 < y1:
+            data[y0:y1, x0:x1] += stamp[y0 - ys[0]:y1 - ys[0], x0 - xs[0]:x1 - xs[0]]
+
+    (offset, slope_x, slope_y) = background
+    (y, x) = np.mgrid[0:naxis, 0:naxis]
+    data += (1000.0 + offset + slope_x * (x - naxis / 2.0) + slope_y * (y - naxis / 2.0)).astype(np.float32)
+    data += rng.normal(0.0, 5.0, data.shape).astype(np.float32)
+    return data
+
+
+'''
+Function to generate the plates of a synthetic field and the image
+table listing them, in the format mArchiveList writes. The URL column
+is relative to the archive root, archive-emulator.py prefixes it
+'''
+def generate_sky(out_dir, ra0, dec0, degrees, plate_degrees, pixel_scale, overlap,
+                 density, fwhm, background_sigma, seed):
+    rng = np.random.default_rng(seed)
+    cdelt = pixel_scale / 3600.0
+    naxis = int(round(plate_degrees / cdelt))
+    layout = plate_layout(ra0, dec0, degrees, plate_degrees, overlap, rng)
+    # stars cover the plates sticking out of the field too
+    stars = star_catalog(ra0, dec0, degrees + 2 * plate_degrees, density, rng)
+
+    plates_dir = os.path.join(out_dir, 'plates')
+    if not os.path.isdir(plates_dir):
+        os.makedirs(plates_dir)
+
+    rows = []
+    for (index, (ra, dec, crota2)) in enumerate(layout):
+        plate_rng = np.random.default_rng([seed, index])
+        background = (plate_rng.normal(0.0, background_sigma),
+                      plate_rng.normal(0.0, background_sigma / naxis),
+                      plate_rng.normal(0.0, background_sigma / naxis))
+        w = tan_wcs(ra, dec, naxis, cdelt, crota2)
+        data = render_plate(w, naxis, stars, fwhm, background, plate_rng)
+
+        f = 'synth%05d.fits' %(index)
+        header = w.to_header()
+        # Montage reads CDELT/CROTA2 rather than the PC matrix astropy writes
+        for key in ('PC1_1', 'PC1_2', 'PC2_1', 'PC2_2'):
+            header.remove(key, ignore_missing=True)
+        header['CDELT1'] = -cdelt
+        header['CDELT2'] = cdelt
+        header['CROTA2'] = crota2
+        header['BUNIT'] = 'counts'
+        header['SKYOFFS'] = (background[0], 'synthetic background offset')
+        fits.writeto(os.path.join(plates_dir, f), data, header, overwrite=True)
+
+        corners = w.wcs_pix2world([[0.5, 0.5], [naxis + 0.5, 0.5], [naxis + 0.5, naxis + 0.5],
+                                   [0.5, naxis + 0.5]], 1)
+        rows.append([index + 1, 'RA---TAN', 'DEC--TAN', 2000.0, naxis, naxis, ra, dec,
+                     (naxis + 1) / 2.0, (naxis + 1) / 2.0, -cdelt, cdelt, crota2, ra, dec] +
+                    [float(v) for corner in corners for v in corner] +
+                    [os.path.getsize(os.path.join(plates_dir, f)), 0, 'plates/' + f, f])
+        sys.stderr.write('\rGenerated %d/%d plates' %(index + 1, len(layout)))
+    sys.stderr.write('\n')
+
+    names = ['cntr', 'ctype1', 'ctype2', 'equinox', 'naxis1', 'naxis2', 'crval1', 'crval2',
+             'crpix1', 'crpix2', 'cdelt1', 'cdelt2', 'crota2', 'ra', 'dec',
+             'ra1', 'dec1', 'ra2', 'dec2', 'ra3', 'dec3', 'ra4', 'dec4', 'size', 'hdu', 'URL', 'file']
+    table = Table(rows=rows, names=names)
+    ascii.write(table, os.path.join(out_dir, 'images.tbl'), format='ipac', overwrite=True)
+    return table
+
+
+'''
+Main
+'''
+
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--center', action = 'store', dest = 'center', default = '56.7 24.0',
+                        help = 'Center of the field, as "RA Dec" in degrees')
+    parser.add_argument('--degrees', action = 'store', dest = 'degrees', type = float, default = 1.0,
+                        help = 'Size of the field, in degrees')
+    parser.add_argument('--plate-degrees', action = 'store', dest = 'plate_degrees', type = float,
+                        default = 0.25, help = 'Size of the plates, in degrees')
+    parser.add_argument('--pixel-scale', action = 'store', dest = 'pixel_scale', type = float,
+                        default = 1.7, help = 'Plate pixel size, in arcseconds')
+    parser.add_argument('--overlap', action = 'store', dest = 'overlap', type = float, default = 0.1,
+                        help = 'Fraction of their width shared by adjacent plates')
+    parser.add_argument('--star-density', action = 'store', dest = 'density', type = float,
+                        default = 5000.0, help = 'Stars per square degree')
+    parser.add_argument('--fwhm', action = 'store', dest = 'fwhm', type = float, default = 2.5,
+                        help = 'Stellar FWHM, in plate pixels')
+    parser.add_argument('--background-sigma', action = 'store', dest = 'background_sigma', type = float,
+                        default = 50.0, help = 'Spread of the per-plate background offsets')
+    parser.add_argument('--seed', action = 'store', dest = 'seed', type = int, default = 632,
+                        help = 'Random seed, the same seed gives the same sky')
+    parser.add_argument('--out-dir', action = 'store', dest = 'out_dir', default = 'synthetic-sky',
+                        help = 'Directory for the plates and images.tbl')
+    args = parser.parse_args()
+
+    (ra0, dec0) = [float(v) for v in args.center.split()]
+    table = generate_sky(args.out_dir, ra0, dec0, args.degrees, args.plate_degrees, args.pixel_scale,
+                         args.overlap, args.density, args.fwhm, args.background_sigma, args.seed)
+    sys.stderr.write("Wrote " + str(len(table)) + " plates and images.tbl to " + args.out_dir + "\n")